@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+##########################
+#
+# Author: Andrej Panicek
+# Desc  : Pool of decoded background images reused for multiple insertions.
+#
+##########################
+import numpy as np
+from collections import OrderedDict
+
+from img_utils import load_img
+
+# Sampling policies of background pool
+#   sequential - backgrounds in order of paths, each one used reuse times in a row
+#   window     - random background from window of cache_size backgrounds, 
+#                used background is replaced by next one when all its uses are spent
+#   random     - random background from all backgrounds with uses left
+POLICIES = ("sequential", "window", "random")
+
+
+class BackgroundPool():
+    """
+    Provide background images for sign insertion. Every background
+    can be used for multiple insertions (reuse), decoded backgrounds
+    are kept in bounded LRU cache, so each one is decoded only once 
+    as long as it stays in cache.
+
+    Returned images are shared with cache, caller must not modify them.
+    Random policies use own random generator seeded by seed.
+    """
+
+    def __init__(self, paths, loader=load_img, cache_size=64, reuse=1, policy="sequential", seed=None):
+        if policy not in POLICIES:
+            raise ValueError("Unknown background policy \"" + policy + "\", valid policies are " + str(POLICIES))
+        self._paths = list(paths)
+        self._loader = loader
+        self._cache_size = max(1, cache_size)
+        self._cache = OrderedDict()
+        self._policy = policy
+        self._random = np.random.RandomState(seed)
+        self._uses = [reuse] * len(self._paths)
+        self._left = reuse * len(self._paths)
+        self._next_path = 0
+        # backgrounds which can be picked by window and random policy
+        self._available = list(range(len(self._paths))) if policy == "random" else []
+
+    def __len__(self):
+        # how many backgrounds can be still provided
+        return self._left
+
+    def _load(self, idx):
+        path = self._paths[idx]
+        if path in self._cache:
+            self._cache.move_to_end(path)
+            return self._cache[path]
+
+        image = self._loader(path)
+        self._cache[path] = image
+        if len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+        return image
+
+    def _pick(self):
+        if self._policy == "sequential":
+            if self._uses[self._next_path] == 0:
+                self._next_path += 1
+            return self._next_path
+
+        if self._policy == "window":
+            while len(self._available) < self._cache_size and self._next_path < len(self._paths):
+                self._available.append(self._next_path)
+                self._next_path += 1
+
+        position = self._random.randint(len(self._available))
+        idx = self._available[position]
+        if self._uses[idx] == 1:
+            # last use, remove from available backgrounds
+            self._available[position] = self._available[-1]
+            self._available.pop()
+        return idx
+
+    def next(self):
+        """
+        Returns:
+            Decoded background image.
+        """
+        return self.next_with_path()[1]
+
+    def next_with_path(self):
+        """
+        Returns:
+            Path of background image and decoded image.
+        """
+        if self._left == 0:
+            raise IndexError("No background images left")
+        idx = self._pick()
+        self._uses[idx] -= 1
+        self._left -= 1
+        return self._paths[idx], self._load(idx)
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+##########################
+#
+# Author: Andrej Panicek
+# Desc  : Benchmark of dataset generation hot paths on synthetic data.
+#
+##########################
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import platform
+import tempfile
+import cv2
+import numpy as np
+
+from img_utils import crop_random_part
+from generate_aug_tmp import augment_batch, normalize_size, remove_empty_space, fix_points, seed_rngs
+from insert_templates_to_bg import add_aug_signs
+from dataset_generator import DatasetGenerator
+
+# Sizes of synthetic data.
+BG_SIZE = (3840, 2160)
+TEMPLATE_SIZES = (100, 300, 1000)
+CROP_SIZES = ((224, 224), (640, 480), (1920, 1080))
+BATCH_SIZES = (1, 8, 32)
+NORM_SIZE = 100
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output', required=True, help='Path to json file where report is stored.')
+    parser.add_argument('--compare', default=None, help='Path to previous report, speedups and keypoint digests are compared with it.')
+    parser.add_argument('--repeat', type=int, default=5, help='How many times measure every case (default 5).')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of synthetic data and augmentations (default 0).')
+    parser.add_argument('--quick', action='store_true', help='Measure only the smallest template size and batch size.')
+    args = parser.parse_args()
+    return args
+
+
+def synth_background(rng, width, height):
+    # Road like background, smooth gradient with noise.
+    gradient = np.linspace(60, 160, height, dtype=np.float32)[:, None, None]
+    noise = rng.normal(0, 20, size=(height, width, 3)).astype(np.float32)
+    return np.clip(gradient + noise, 0, 255).astype(np.uint8)
+
+
+def synth_template(rng, size):
+    """
+    Sign template (BGRA) of size x size, filled triangle with
+    transparent surrounding.
+
+    Returns:
+        Template image and its keypoints (corners of triangle).
+    """
+    template = np.zeros((size, size, 4), dtype=np.uint8)
+    points = [[size // 2, size // 10], [size // 10, size - size // 10], [size - size // 10, size - size // 10]]
+    color = [int(c) for c in rng.randint(0, 256, size=3)] + [255]
+    cv2.fillPoly(template, [np.array(points, dtype=np.int32)], color)
+    template[:, :, :3] = np.where(template[:, :, 3:4] > 0,
+                                  np.clip(template[:, :, :3] + rng.randint(-10, 10, size=(size, size, 3)), 0, 255),
+                                  0).astype(np.uint8)
+    return template, points
+
+
+def measure(func, repeat, seed):
+    """
+    Call func repeat times (after single warm up call), random
+    generators are seeded before every call.
+
+    Returns:
+        Mean and minimum time of single call in milliseconds.
+    """
+    seed_rngs(seed)
+    func()
+    times = []
+    for _ in range(repeat):
+        seed_rngs(seed)
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return 1000 * float(np.mean(times)), 1000 * float(np.min(times))
+
+
+def keypoints_digest(templates, seed):
+    """
+    Hash of augmented keypoints and sizes of augmented images for fixed
+    seed. Optimization which does not change augmentation keeps the digest.
+    """
+    digest = hashlib.sha1()
+    for template, points in templates:
+        norm_img, norm_points = normalize_size(template, points, NORM_SIZE, NORM_SIZE)
+        seed_rngs(seed)
+        for img_aug, aug_points in augment_batch(norm_img, norm_points, 16):
+            digest.update(json.dumps([list(img_aug.shape), aug_points]).encode())
+    return digest.hexdigest()
+
+
+def run_benchmarks(args):
+    rng = np.random.RandomState(args.seed)
+    background = synth_background(rng, *BG_SIZE)
+    template_sizes = TEMPLATE_SIZES[:1] if args.quick else TEMPLATE_SIZES
+    batch_sizes = BATCH_SIZES[:1] if args.quick else BATCH_SIZES
+    templates = {size: synth_template(rng, size) for size in template_sizes}
+    results = []
+
+    def add(name, params, func, samples=1):
+        mean_ms, min_ms = measure(func, args.repeat, args.seed)
+        results.append({"name": name, "params": params, "mean_ms": mean_ms, "min_ms": min_ms,
+                        "per_sample_ms": mean_ms / samples})
+        print(name, params, format(mean_ms, ".3f"), "ms", flush=True)
+
+    for width, height in CROP_SIZES:
+        add("crop_random_part", {"width": width, "height": height},
+            lambda: crop_random_part(background, width, height).copy())
+
+    for size, (template, points) in templates.items():
+        add("normalize_size", {"size": size}, lambda: normalize_size(template, points, NORM_SIZE, NORM_SIZE))
+
+        # templates are augmented after normalization, as in generate_aug_tmp
+        norm_img, norm_points = normalize_size(template, points, NORM_SIZE, NORM_SIZE)
+        for batch in batch_sizes:
+            for pyramid in (False, True):
+                add("augment_img", {"size": size, "norm_size": NORM_SIZE, "batch": batch, "pyramid": pyramid},
+                    lambda: augment_batch(norm_img, norm_points, batch, pyramid), batch)
+
+        # fully augmented template has empty space around sign
+        padded = cv2.copyMakeBorder(template, size // 2, size // 2, size // 2, size // 2, cv2.BORDER_CONSTANT, value=0)
+        padded_points = [[x + size // 2, y + size // 2] for x, y in points]
+
+        def remove_and_fix():
+            image, rows, columns = remove_empty_space(padded)
+            return image, fix_points(padded_points, rows, columns)
+        add("remove_empty_space", {"size": size}, remove_and_fix)
+
+        crop = crop_random_part(background, 640, 480).copy()
+        add("add_aug_signs", {"size": NORM_SIZE}, lambda: add_aug_signs(crop, norm_img, [10, 10]))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for image_format in ("jpg", "tar"):
+            for width, height in CROP_SIZES[:2]:
+                root = os.path.join(tmp_dir, image_format + str(width))
+                os.mkdir(root)
+                crop = crop_random_part(background, width, height).copy()
+                with DatasetGenerator(root, image_format=image_format) as dataset:
+                    add("DatasetGenerator.add_image", {"image_format": image_format, "width": width, "height": height},
+                        lambda: dataset.add_image(crop, [0, 0, 10, 10], "A"))
+
+    return {"platform": {"python": platform.python_version(), "machine": platform.machine(),
+                         "opencv": cv2.__version__, "numpy": np.__version__},
+            "seed": args.seed,
+            "repeat": args.repeat,
+            "template_sizes": list(template_sizes),
+            "keypoints_digest": keypoints_digest(list(templates.values()), args.seed),
+            "results": results}
+
+
+def case_key(result):
+    return result["name"] + json.dumps(result["params"], sort_keys=True)
+
+
+def compare_reports(report, previous):
+    """
+    Print speedup of every case measured in both reports and
+    check that augmented keypoints did not change.
+
+    Returns:
+        True if keypoint digests are the same.
+    """
+    old_results = {case_key(result): result for result in previous["results"]}
+    for result in report["results"]:
+        old = old_results.get(case_key(result))
+        if old is None:
+            continue
+        print(result["name"], result["params"], "speedup", format(old["mean_ms"] / result["mean_ms"], ".2f"))
+
+    if report["template_sizes"] != previous["template_sizes"]:
+        print("Keypoints not compared, reports use different templates")
+        return True
+    same = report["keypoints_digest"] == previous["keypoints_digest"]
+    print("Keypoints", "unchanged" if same else "CHANGED")
+    return same
+
+
+def main():
+    """
+    Measure hot paths of dataset generation on synthetic 4K background
+    and sign templates (no input data needed) and store report as json.
+    Report contains digest of augmented keypoints, so it can be checked
+    that optimization did not change results (script argument "compare").
+    """
+    args = parse_arguments()
+    report = run_benchmarks(args)
+    with open(args.output, "w") as report_file:
+        json.dump(report, report_file, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare, "r") as previous_file:
+            previous = json.load(previous_file)
+        if not compare_reports(report, previous):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
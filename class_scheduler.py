@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+##########################
+#
+# Author: Andrej Panicek
+# Desc  : Class balanced scheduling of generated samples.
+#
+##########################
+import sys
+import json
+
+
+def load_targets(path: str):
+    # Load target number of samples of every class (sign type),
+    # json file {"type": count, ...}.
+    with open(path, "r") as targets_file:
+        return json.load(targets_file)
+
+
+def missing_counts(targets: dict, counts: dict):
+    """
+    Returns:
+        Dictionary with number of samples which are missing to target
+        of every class.
+    """
+    return {sign_type: max(0, target - counts.get(sign_type, 0)) for sign_type, target in targets.items()}
+
+
+def interleave(missing: dict):
+    """
+    Order samples of all classes, so samples of every class are spread
+    evenly over the whole order. Any prefix of the order contains classes
+    in the same ratio as the whole order, so partial run stays balanced.
+
+    Returns:
+        List of classes, every class is in it as many times as is missing.
+    """
+    keys = []
+    for class_idx, (sign_type, count) in enumerate(sorted(missing.items())):
+        keys.extend(((idx + 0.5) / count, class_idx, sign_type) for idx in range(count))
+    return [sign_type for _, _, sign_type in sorted(keys)]
+
+
+def schedule(templates: list, targets: dict, counts: dict):
+    """
+    Choose augmented templates which have to be inserted to reach
+    target number of samples of every class.
+
+    Templates of class are used in order, continuing after those used
+    for samples already in dataset. When class has less templates than
+    missing samples, its templates are used repeatedly.
+
+    Args:
+        templates: descriptions of augmented templates (type, filename, ...)
+        targets: target number of samples of every class
+        counts: number of samples of every class already in dataset
+
+    Returns:
+        Descriptions of templates to insert, classes are interleaved.
+    """
+    by_type = {}
+    for temp in templates:
+        by_type.setdefault(temp["type"], []).append(temp)
+
+    missing = missing_counts(targets, counts)
+    for sign_type in list(missing):
+        if missing[sign_type] > 0 and sign_type not in by_type:
+            print("No templates of class", sign_type, ", its samples are skipped", file=sys.stderr)
+            del missing[sign_type]
+
+    used = {sign_type: counts.get(sign_type, 0) for sign_type in missing}
+    scheduled = []
+    for sign_type in interleave(missing):
+        class_templates = by_type[sign_type]
+        scheduled.append(class_templates[used[sign_type] % len(class_templates)])
+        used[sign_type] += 1
+    return scheduled
@@ -7,19 +7,104 @@
 ##########################  
 import os
 import sys
-from PIL import Image
+import io
+import csv
+import json
+import time
+import fcntl
+import tarfile
+import argparse
+import itertools
+import cv2
+import numpy as np
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+
+from img_utils import store_img
+from write_behind import WriteBehind
+from profiler import stage, record_queue
+
+# Ground truth storage formats
+#   txt - one gt/<index>.txt file for every image
+#   csv - all ground truths in single gt.csv file, written in batches
+GT_FORMATS = ("txt", "csv")
+GT_CSV_NAME = "gt.csv"
+GT_CSV_HEADER = ["image", "x", "y", "width", "height", "type"]
+
+# Image storage formats
+#   jpg - one images/<index>.jpg file for every image
+#   tar - images with their ground truths packed in shards/shard-<n>.tar 
+#         files (WebDataset layout, <index>.jpg and <index>.txt members)
+IMAGE_FORMATS = ("jpg", "tar")
+SHARD_NAME = "shard-{:06d}.tar"
+
+# Dataset manifest, holds number of committed images, so index of next 
+# image is known without scanning images directory, and number of 
+# committed objects of every class (sign type).
+MANIFEST_NAME = "manifest.json"
+
+# Lock file of dataset manifest used by shared datasets, it is locked
+# by flock and never removed. Lock is released by system when writer
+# crashes, so there are no stale locks.
+LOCK_NAME = "manifest.lock"
 
 class DatasetGenerator():
     """
     Generate structure of simple dataset in filesystem.
     Store images in it with proper ground truth.
+
+    Ground truths in csv format are buffered and written after every
+    flush_every images, call close() (or use the object as context 
+    manager) to write the rest.
+
+    In tar image format every shard holds shard_size images, ground 
+    truth of each image is stored in the shard next to it. Every run
+    starts new shard.
+
+    Images are committed into dataset manifest after every flush_every
+    images (in tar format after every full shard) and on close(). After
+    crash the generation continues from last committed image, images 
+    stored after it are overwritten. Manifest also counts committed 
+    objects of every class, see class_counts().
+
+    Shared dataset can be filled by multiple processes (or machines) at 
+    the same time. Every writer reserves blocks of reserve_size indexes
+    (and shard numbers) in manifest under lock file, so writers never
+    overwrite each other. Ground truths are appended into gt.csv under 
+    the same lock. Indexes reserved by crashed writer stay unused.
+
+    Images (jpg format) and txt ground truths can be stored by io_threads
+    writer threads. Images passed to add_image must not be modified 
+    afterwards.
     """
     
-    def __init__(self, dataset_root_path):
+    def __init__(self, dataset_root_path, gt_format="txt", flush_every=1000,
+                 image_format="jpg", shard_size=1000, shared=False, reserve_size=None,
+                 io_threads=0):
+        if gt_format not in GT_FORMATS:
+            raise ValueError("Unknown ground truth format \"" + gt_format + "\", valid formats are " + str(GT_FORMATS))
+        if image_format not in IMAGE_FORMATS:
+            raise ValueError("Unknown image format \"" + image_format + "\", valid formats are " + str(IMAGE_FORMATS))
         self._gt_path = None
         self._img_path = None
         self._curr_index = None
         self._root_path = dataset_root_path
+        self._gt_format = gt_format
+        self._flush_every = flush_every
+        self._gt_buffer = []
+        self._image_format = image_format
+        self._shard_size = shard_size
+        self._shard = None
+        self._shard_count = 0
+        self._shard_images = 0
+        self._pending = 0
+        self._shared = shared
+        self._reserve_size = reserve_size or flush_every
+        self._reserved_end = 0
+        self._committed_index = 0
+        self._class_counts = Counter()
+        self._new_classes = Counter()
+        self._writer = WriteBehind(io_threads)
         self._init_dataset_dirs()
         
     def _init_dataset_dirs(self):
@@ -27,8 +112,44 @@ class DatasetGenerator():
         Check proper structure of dataset dirs.
         """
         self._gt_path =  self._create_dir("gt")
-        self._img_path = self._create_dir("images")
-        img_count = self._current_count()
+        if self._image_format == "tar":
+            self._img_path = self._create_dir("shards")
+        else:
+            self._img_path = self._create_dir("images")
+
+        with self._lock() if self._shared else nullcontext():
+            if self._gt_format == "csv":
+                self._gt_path = os.path.join(os.path.abspath(self._root_path), GT_CSV_NAME)
+                if not os.path.isfile(self._gt_path):
+                    with open(self._gt_path, "w", newline="") as gt_file:
+                        csv.writer(gt_file).writerow(GT_CSV_HEADER)
+
+            manifest = self._load_manifest()
+            if (manifest is not None and not self._shared and self._gt_format == "csv"
+                    and os.path.getsize(self._gt_path) > manifest.get("gt_size", 0) > 0):
+                # remove ground truths of images which were not committed,
+                # before classes are counted from them
+                with open(self._gt_path, "r+") as gt_file:
+                    gt_file.truncate(manifest["gt_size"])
+
+            if manifest is None:
+                self._current_count()
+                self._class_counts = self._scan_classes()
+                self._write_manifest()
+            elif "classes" not in manifest:
+                # manifest of older version, index of classes is created from ground truths
+                manifest["classes"] = dict(self._scan_classes())
+                self._write_manifest(manifest)
+
+            if manifest is not None and not self._shared:
+                self._curr_index = manifest["count"]
+                self._shard_count = manifest["shards"]
+                self._class_counts = Counter(manifest["classes"])
+
+        if self._shared:
+            # indexes are reserved with first image
+            self._curr_index = self._reserved_end = 0
+        self._committed_index = self._curr_index
 
     def _create_dir(self, path):
         path = os.path.abspath(os.path.join(self._root_path, path))
@@ -43,35 +164,266 @@ class DatasetGenerator():
     def _current_count(self):
         """
         Set index for how many images dataset already contains, so we wont overwritte any of them. 
+        Used only for datasets without manifest, the highest index of stored image is used.
+        """
+        if self._image_format == "tar":
+            shards = [shard for shard in os.listdir(self._img_path) if shard_number(shard) is not None]
+            # shards can be missing, new shard must not take name of existing one
+            self._shard_count = max((shard_number(shard) for shard in shards), default=-1) + 1
+            names = []
+            for shard in shards:
+                names.extend(name for name, _ in read_shard(os.path.join(self._img_path, shard)))
+        else:
+            names = os.listdir(self._img_path)
+        indexes = [int(name[:-4]) for name in names if name.endswith(".jpg") and name[:-4].isdigit()]
+        self._curr_index = max(indexes, default=0)
+
+    def _scan_classes(self):
+        """
+        Count objects of every class in stored ground truths, used only for
+        datasets without index of classes in manifest.
+        """
+        counts = Counter()
+        if self._gt_format == "csv":
+            with open(self._gt_path, "r", newline="") as gt_file:
+                counts.update(row["type"] for row in csv.DictReader(gt_file))
+        elif self._image_format == "tar":
+            for shard in sorted(os.listdir(self._img_path)):
+                if not shard.endswith(".tar"):
+                    continue
+                for _, data in read_shard(os.path.join(self._img_path, shard), ".txt"):
+                    if data is not None:
+                        counts.update(gt_types(data.decode()))
+        else:
+            for name in os.listdir(self._gt_path):
+                if name.endswith(".txt"):
+                    with open(os.path.join(self._gt_path, name), "r") as gt_file:
+                        counts.update(gt_types(gt_file.read()))
+        return counts
+
+    def class_counts(self):
         """
-        self._curr_index = len([image for image in os.listdir(self._img_path) if os.path.isfile(os.path.join(self._img_path, image))])
+        Returns:
+            Dictionary with number of committed objects of every class 
+            (sign type) in dataset, for shared dataset including objects 
+            committed by other writers.
+        """
+        manifest = self._load_manifest()
+        return dict(manifest.get("classes", {}))
+
+    def _load_manifest(self):
+        path = os.path.join(self._root_path, MANIFEST_NAME)
+        if not os.path.isfile(path):
+            return None
+        with open(path, "r") as manifest_file:
+            return json.load(manifest_file)
+
+    def _write_manifest(self, manifest=None):
+        """
+        Atomically replace dataset manifest with given manifest 
+        or with current state.
+        """
+        if manifest is None:
+            manifest = {"count": self._curr_index, "shards": self._shard_count,
+                        "classes": dict(self._class_counts)}
+            if self._gt_format == "csv":
+                manifest["gt_size"] = os.path.getsize(self._gt_path)
+
+        path = os.path.join(self._root_path, MANIFEST_NAME)
+        with open(path + ".tmp", "w") as manifest_file:
+            json.dump(manifest, manifest_file)
+            manifest_file.flush()
+            os.fsync(manifest_file.fileno())
+        os.replace(path + ".tmp", path)
+
+    @contextmanager
+    def _lock(self):
+        """
+        Exclusive access to dataset manifest, flock of lock file blocks
+        until other writer releases it. Lock is held as long as needed
+        (no timeout), so slow scans of dataset under lock are safe.
+        Writers on different machines need filesystem with working locks
+        (on NFS Linux maps flock to POSIX byte range locks).
+        """
+        path = os.path.join(self._root_path, LOCK_NAME)
+        with open(path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @contextmanager
+    def _locked_manifest(self):
+        # Load manifest under lock, changes are written back.
+        with self._lock():
+            manifest = self._load_manifest()
+            yield manifest
+            self._write_manifest(manifest)
+
+    def _reserve_indexes(self):
+        with self._locked_manifest() as manifest:
+            self._curr_index = manifest["count"]
+            manifest["count"] += self._reserve_size
+            self._reserved_end = manifest["count"]
+
+    def _reserve_shard(self):
+        with self._locked_manifest() as manifest:
+            self._shard_count = manifest["shards"]
+            manifest["shards"] += 1
 
     def _gen_new_index(self):
+        if self._shared and self._curr_index >= self._reserved_end:
+            self._reserve_indexes()
         self._curr_index += 1
         return self._curr_index
     
-    def add_image(self, image: Image, coords: list, sign_type: str):
+    def add_image(self, image, coords: list, sign_type: str):
+        # image can be Pillow Image or Opencv (BGR numpy array) image
+        return self.add_objects(image, [coords], [sign_type])
+
+    def add_objects(self, image, coords_list: list, sign_types: list):
+        """
+        Store image with multiple objects, ground truth contains
+        bounding box and type of every object.
+
+        Returns:
+            Index of stored image.
+        """
         index = str(self._gen_new_index()) 
 
-        bbox = self._transform_coords(coords)
-        self._store_image(index, image)
-        self._store_data(index, bbox, sign_type)
+        bboxes = [self._transform_coords(coords) for coords in coords_list]
+        self._new_classes.update(sign_types)
+        if self._image_format == "tar":
+            self._store_shard_sample(index, image, bboxes, sign_types)
+        else:
+            self._store_image(index, image)
+        self._store_data(index, bboxes, sign_types)
+
+        self._pending += 1
+        record_queue("write", self._writer.pending())
+        if self._image_format == "tar":
+            if self._shard_images >= self._shard_size:
+                self.flush()
+        elif self._pending >= self._flush_every:
+            self.flush()
+        return int(index)
 
     def _store_image(self, name, image):
         image_name = name + ".jpg"
         path = os.path.join(self._img_path, image_name)
-        image.save(path)
+        if isinstance(image, np.ndarray):
+            self._writer.submit(store_img, path, image)
+        else:
+            self._writer.submit(image.save, path)
+
+    def _store_shard_sample(self, name, image, bboxes, sign_types):
+        """
+        Add image and its ground truth into current shard,
+        new shard is opened when the current one is full.
+        """
+        if self._shard is None:
+            if self._shared:
+                self._reserve_shard()
+            path = os.path.join(self._img_path, SHARD_NAME.format(self._shard_count))
+            self._shard = tarfile.open(path, "w")
+            self._shard_count += 1
+
+        self._add_shard_member(name + ".jpg", encode_jpg(image))
+        self._add_shard_member(name + ".txt", format_gt(bboxes, sign_types).encode())
+        self._shard_images += 1
+
+    def _add_shard_member(self, name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = time.time()
+        with stage("write"):
+            self._shard.addfile(info, io.BytesIO(data))
+
+    def _close_shard(self):
+        if self._shard is not None:
+            self._shard.close()
+            self._shard = None
+            self._shard_images = 0
     
-    def _store_data(self, name, bbox, sign_type):
+    def _store_data(self, name, bboxes, sign_types):
+        if self._gt_format == "csv":
+            for bbox, sign_type in zip(bboxes, sign_types):
+                self._gt_buffer.append([name] + [int(point) for point in bbox] + [sign_type])
+            return
+        if self._image_format == "tar":
+            # ground truth is already stored in shard
+            return
+
         data_name = name + ".txt"
         path = os.path.join(self._gt_path, data_name)
+        self._writer.submit(store_gt, path, format_gt(bboxes, sign_types))
 
-        with open(path, "w") as gt_data:        
-            for point in bbox:
-                gt_data.write(str(int(point)))
-                gt_data.write(" ")
+    def flush(self):
+        """
+        Write buffered ground truths into file, close current shard
+        and commit stored images into manifest.
+        """
+        # images have to be stored before they are committed
+        self._writer.join()
+        if self._shared:
+            self._flush_shared()
+            self._committed_index = self._curr_index
+            return
+
+        if len(self._gt_buffer) > 0:
+            with open(self._gt_path, "a", newline="") as gt_file:
+                csv.writer(gt_file).writerows(self._gt_buffer)
+            self._gt_buffer = []
+        self._close_shard()
+
+        if self._pending > 0:
+            self._class_counts.update(self._new_classes)
+            self._new_classes.clear()
+            self._write_manifest()
+            self._pending = 0
+        self._committed_index = self._curr_index
+
+    def committed_index(self):
+        """
+        Returns:
+            Index of the last image stored by this writer which is committed,
+            images are stored with increasing indexes.
+        """
+        return self._committed_index
+
+    def _flush_shared(self):
+        # Stored images are already reserved in manifest, only ground
+        # truths are appended and classes are counted.
+        self._close_shard()
+        if len(self._gt_buffer) > 0 or len(self._new_classes) > 0:
+            with self._locked_manifest() as manifest:
+                if len(self._gt_buffer) > 0:
+                    with open(self._gt_path, "a", newline="") as gt_file:
+                        csv.writer(gt_file).writerows(self._gt_buffer)
+                    manifest["gt_size"] = os.path.getsize(self._gt_path)
+                classes = Counter(manifest.get("classes", {}))
+                classes.update(self._new_classes)
+                manifest["classes"] = dict(classes)
+            self._gt_buffer = []
+            self._new_classes.clear()
+        self._pending = 0
+
+    def close(self):
+        self.flush()
+        self._writer.close()
+        if self._shared and self._curr_index < self._reserved_end:
+            with self._locked_manifest() as manifest:
+                # return unused indexes if nobody reserved after us
+                if manifest["count"] == self._reserved_end:
+                    manifest["count"] = self._curr_index
+            self._reserved_end = self._curr_index
+
+    def __enter__(self):
+        return self
 
-            gt_data.write(sign_type)
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
         
     def _transform_coords(self, coords: list):
         """
@@ -82,5 +434,93 @@ class DatasetGenerator():
                 coords[2] - coords[0],
                 coords[3] - coords[1]]
 
-  
 
+def shard_number(name):
+    # Number of shard from its file name, None if name is not shard name.
+    prefix, suffix = SHARD_NAME.split("{")[0], ".tar"
+    number = name[len(prefix):-len(suffix)]
+    if name.startswith(prefix) and name.endswith(suffix) and number.isdigit():
+        return int(number)
+    return None
+
+
+def read_shard(path, data_suffix=None):
+    """
+    Read members of shard. Shard truncated by crash is read up 
+    to its first damaged member.
+
+    Args:
+        path: path to shard
+        data_suffix: data of members with this suffix is read too
+
+    Returns:
+        List of (name, data) pairs, data is None for members without data_suffix.
+    """
+    members = []
+    try:
+        with tarfile.open(path) as tar:
+            for member in tar:
+                data = None
+                if data_suffix is not None and member.name.endswith(data_suffix):
+                    data = tar.extractfile(member).read()
+                members.append((member.name, data))
+    except (tarfile.ReadError, EOFError):
+        pass
+    return members
+
+
+def encode_jpg(image):
+    # Encode Pillow Image or Opencv image into JPEG.
+    with stage("encode"):
+        if isinstance(image, np.ndarray):
+            return cv2.imencode(".jpg", image)[1].tobytes()
+        image_data = io.BytesIO()
+        image.save(image_data, format="JPEG")
+        return image_data.getvalue()
+
+
+def format_gt(bboxes, sign_types):
+    # Ground truth of single image in txt format "x y width height type",
+    # one line for every object.
+    lines = []
+    for bbox, sign_type in zip(bboxes, sign_types):
+        lines.append("".join(str(int(point)) + " " for point in bbox) + sign_type)
+    return "\n".join(lines)
+
+
+def gt_types(gt):
+    # Types of objects in ground truth of single image in txt format.
+    return [line.split(" ", 4)[4] for line in gt.splitlines() if line.strip() != ""]
+
+
+def store_gt(path, gt):
+    with stage("write"):
+        with open(path, "w") as gt_data:        
+            gt_data.write(gt)
+
+
+def export_gt_files(dataset_root_path):
+    """
+    Create gt/<index>.txt file for every record of dataset gt.csv file,
+    the same layout as dataset generated with txt ground truth format.
+    """
+    gt_dir = os.path.join(dataset_root_path, "gt")
+    os.makedirs(gt_dir, exist_ok=True)
+
+    with open(os.path.join(dataset_root_path, GT_CSV_NAME), "r", newline="") as gt_file:
+        # rows of single image are always next to each other
+        for image, rows in itertools.groupby(csv.DictReader(gt_file), key=lambda row: row["image"]):
+            rows = list(rows)
+            bboxes = [[row["x"], row["y"], row["width"], row["height"]] for row in rows]
+            store_gt(os.path.join(gt_dir, image + ".txt"), format_gt(bboxes, [row["type"] for row in rows]))
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Export ground truths of dataset from gt.csv into gt/<index>.txt files.')
+    parser.add_argument('--dataset', required=True, help='Path to dataset generated with csv ground truth format.')
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    export_gt_files(parse_arguments().dataset)
@@ -8,14 +8,20 @@
 import sys
 import os
 import cv2
-import copy
+import json
 import argparse
+import itertools
+from multiprocessing import Pool, Barrier
 import imgaug as ia
 import imgaug.augmenters as iaa
 from imgaug.augmentables import Keypoint, KeypointsOnImage
 
-from templates_utils import load_templates_structure, store_templates_structure, gen_template_dir
+from templates_utils import load_templates_structure, iter_templates_structure, TemplatesStructureWriter, gen_template_dir
+from template_cache import TemplateCache, template_key
+from class_scheduler import load_targets
 from img_utils import *
+from write_behind import WriteBehind
+from profiler import Profiler, stage, record_queue, take_stats
 import numpy as np
 
 # We need to prevent augmentation of ALPHA channel, 
@@ -23,17 +29,34 @@ import numpy as np
 #
 # seq_affine - affine transformation should be used on every channel (BGRA)
 # seq_other -  other transformations which should be used only on color (BGR) channels
-seq_affine = iaa.Sequential([
-    iaa.Affine(fit_output=True,
-               rotate=(-15, 15),
-               scale=(0.10, 1),
-               shear=(-25, 25)
-               ),
-    ])
-seq_other = iaa.Sequential([
-    iaa.Sometimes(0.5, iaa.GammaContrast((0.25, 1.75))),
-    iaa.Sometimes(0.5, iaa.MotionBlur((3,5)))
-    ])
+AFFINE_SCALE = (0.10, 1)
+
+def make_affine(scale):
+    # Affine transformation of templates with given range of scale.
+    return iaa.Sequential([
+        iaa.Affine(fit_output=True,
+                   rotate=(-15, 15),
+                   scale=scale,
+                   shear=(-25, 25)
+                   ),
+        ])
+
+def make_other():
+    # Color transformations of templates.
+    return iaa.Sequential([
+        iaa.Sometimes(0.5, iaa.GammaContrast((0.25, 1.75))),
+        iaa.Sometimes(0.5, iaa.MotionBlur((3,5)))
+        ])
+
+seq_affine = make_affine(AFFINE_SCALE)
+seq_other = make_other()
+
+def seeded(augmenter, rng):
+    # Give augmenter own random generator seeded from rng (np.random.RandomState),
+    # without rng augmenter uses global generator of imgaug.
+    if rng is not None:
+        augmenter.seed_(rng.randint(0, 2**31 - 1))
+    return augmenter
 
 def parse_arguments():
     parser = argparse.ArgumentParser()
@@ -41,8 +64,17 @@ def parse_arguments():
     parser.add_argument('--temp_data', required=True, help='Path to json file which contains description about each sign.')
     parser.add_argument('--dest', required=True, help='Path to directory where augmented images will be stored.')
     parser.add_argument('--count', type=int, required=True, help='How many augmented images create from each sign.')
+    parser.add_argument('--targets', default=None, help='Path to json file with number of augmented images of every sign type {"type": count}, other types get --count.')
     parser.add_argument('--max_w', type=int, required=True, help='Maximum width of sign.')
     parser.add_argument('--max_h', type=int, required=True, help='Maximum height of sign.')
+    parser.add_argument('--batch', type=int, default=32, help='How many augmented images create by single augmenter call.')
+    parser.add_argument('--pyramid', action='store_true', help='Scale down templates from precomputed pyramid levels instead of full size template.')
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes (default 1, no pool).')
+    parser.add_argument('--cache', default=None, help='Path to directory with cache of normalized templates.')
+    parser.add_argument('--incremental', action='store_true', help='Augment only new or changed templates, keep augmented images of the others.')
+    parser.add_argument('--io_threads', type=int, default=0, help='Number of threads which encode and store images, 0 stores images in main thread (default 0).')
+    parser.add_argument('--seed', type=int, default=None, help='Base seed of random generators, random if not set.')
+    parser.add_argument('--stats', default=None, help='Path to json file where statistics of run (stage timings, samples per second) are stored.')
     args = parser.parse_args()
     return args
 
@@ -58,106 +90,222 @@ def generate_keypoints(points, img_shape):
     return KeypointsOnImage(key_points, img_shape)
 
 
-def lower_values(list_of_values, threshold):
-    """
-    Count how many values in list are smaler than some threshold.
-    """
-    lower = 0
-    for x in list_of_values:
-        if x < threshold:
-            lower += 1
-    return lower
-
-
 def fix_points(points, deleted_rows, delete_columns):
     """
     Move points coordinates based on how many columns or rows
-    were deleted.
+    were deleted. Both lists of deleted indexes have to be sorted.
     """
-    new_points = []
-    for point in points:
-        new_x = point[0] - lower_values(delete_columns, point[0])
-        new_y = point[1] - lower_values(deleted_rows, point[1])
-        new_points.append([new_x, new_y])
-    return new_points
+    points = np.asarray(points).reshape(-1, 2)
+    new_x = points[:, 0] - np.searchsorted(delete_columns, points[:, 0], side="left")
+    new_y = points[:, 1] - np.searchsorted(deleted_rows, points[:, 1], side="left")
+    return np.stack((new_x, new_y), axis=1).tolist()
 
 
 def remove_empty_space(image):
     """
     Remove rows and columns from image where values in
     alpha channel equals to zero on every position. 
+
+    After affine transformation the empty space is at the edges of
+    image, so the result is only view of sign bounding box. Empty 
+    rows or columns inside of sign (if any) are deleted as well.
+
+    Returns:
+        image without empty space, sorted indexes of deleted rows
+        and sorted indexes of deleted columns
     """
+    with stage("remove_empty_space"):
+        return _remove_empty_space(image)
+
 
+def _remove_empty_space(image):
     alpha = image[:,:,3]
-    empty_row = np.zeros(alpha.shape[1], dtype=int)
-    empty_column = np.zeros(alpha.shape[0], dtype=int)
+    used_row = alpha.any(axis=1)
+    used_colm = alpha.any(axis=0)
 
-    idx_rows = np.argwhere(np.all(alpha[:, ...] == 0, axis=1))
-    idx_colm = np.argwhere(np.all(alpha[..., :] == 0, axis=0))
-    
-    image = np.delete(image, idx_rows, axis=0)
-    image = np.delete(image, idx_colm, axis=1)
+    idx_rows = np.flatnonzero(~used_row)
+    idx_colm = np.flatnonzero(~used_colm)
+
+    if len(idx_rows) == len(used_row) or len(idx_colm) == len(used_colm):
+        return image[0:0, 0:0], idx_rows, idx_colm
+
+    top, bottom = np.argmax(used_row), len(used_row) - np.argmax(used_row[::-1])
+    left, right = np.argmax(used_colm), len(used_colm) - np.argmax(used_colm[::-1])
+    image = image[top:bottom, left:right]
+
+    inner_rows = idx_rows[(idx_rows > top) & (idx_rows < bottom)]
+    inner_colm = idx_colm[(idx_colm > left) & (idx_colm < right)]
+    if len(inner_rows) > 0:
+        image = np.delete(image, inner_rows - top, axis=0)
+    if len(inner_colm) > 0:
+        image = np.delete(image, inner_colm - left, axis=1)
     
     return image, idx_rows, idx_colm
 
 
-def augment(image, aug_obj, points_to_keep=[]):
+def keypoints_to_points(key_points):
     """
-    Augmentation of image. The result is new image with 
-    new coordiantes of points.
+    Convert KeypointsOnImage object back to list of points
+    [[x coordinate, y coordinate], ...].
     """
-    if len(points_to_keep) > 0:
-        k_points = generate_keypoints(points_to_keep, image.shape)
-
-    img_aug, point_aug = aug_obj(image=image, keypoints=k_points)
-
     new_points = []
-    for i in range(len(point_aug.keypoints)):
-        point = point_aug.keypoints[i]
+    for point in key_points.keypoints:
         new_points.append([int(point.x), int(point.y)])
+    return new_points
 
-    return img_aug, new_points
 
+def build_pyramid(image, points, min_scale=AFFINE_SCALE[0]):
+    """
+    Create resolution pyramid of image, every level has half size
+    of the previous one. Levels are created while half of scale of the
+    last level is above min_scale.
 
-def augment_img(image, keypoints):
+    Returns:
+        List of (level image, points in level image, scale of level).
     """
-    Augment input image with two globaly defined transformation
-    seq_affine and seq_others.
+    origin_h, origin_w = image.shape[:2]
+    levels = [(image, points, 1.0)]
+    scale = 1.0
+    while scale / 2 > min_scale and min(image.shape[:2]) > 1:
+        scale /= 2
+        image = cv2.resize(image, (max(1, round(image.shape[1] / 2)), max(1, round(image.shape[0] / 2))),
+                           interpolation=cv2.INTER_AREA)
+        level_points = [[x * image.shape[1] / origin_w, y * image.shape[0] / origin_h] for x, y in points]
+        levels.append((image, level_points, scale))
+    return levels
+
+
+def affine_batch(image, keypoints, count, pyramid=False, rng=None):
+    """
+    Apply affine transformation to count copies of image. Scale of
+    every copy is uniform from AFFINE_SCALE.
+
+    With pyramid, each copy is transformed from the smallest pyramid level
+    which is still bigger than its scale, with residual scale. Copies are
+    split between levels by length of scale interval of each level, so
+    distribution of scale stays the same.
+
+    Random generators of this call are derived from rng (np.random.RandomState),
+    global generators of numpy and imgaug are used if it is None.
+
+    Returns:
+        List of augmented images and list of augmented KeypointsOnImage.
+    """
+    if not pyramid:
+        k_points = generate_keypoints(keypoints, image.shape)
+        augmenter = seq_affine if rng is None else seeded(make_affine(AFFINE_SCALE), rng)
+        return augmenter(images=[image] * count, keypoints=[k_points] * count)
+
+    low, high = AFFINE_SCALE
+    levels = build_pyramid(image, keypoints, low)
+    # interval of scale covered by every level, the last level covers
+    # everything down to the lowest scale
+    intervals = [(max(low, scale / 2), min(high, scale)) for _, _, scale in levels]
+    intervals[-1] = (low, intervals[-1][1])
+    lengths = np.array([max(0, top - bottom) for bottom, top in intervals])
+    level_idx = (np.random if rng is None else rng).choice(len(levels), size=count, p=lengths / lengths.sum())
+
+    imgs_aug = [None] * count
+    points_aug = [None] * count
+    for idx, (level_img, level_points, scale) in enumerate(levels):
+        samples = np.flatnonzero(level_idx == idx)
+        if len(samples) == 0:
+            continue
+        bottom, top = intervals[idx]
+        k_points = generate_keypoints(level_points, level_img.shape)
+        level_imgs, level_kps = seeded(make_affine((bottom / scale, top / scale)), rng)(
+            images=[level_img] * len(samples), keypoints=[k_points] * len(samples))
+        for sample, img_aug, point_aug in zip(samples, level_imgs, level_kps):
+            imgs_aug[sample] = img_aug
+            points_aug[sample] = point_aug
+    return imgs_aug, points_aug
+
+
+def color_batch(images, rng=None):
+    """
+    Apply color transformations (seq_other) to images.
+
+    With rng (np.random.RandomState) own augmenter seeded from it is used.
+    MotionBlur draws from global generator of imgaug even then (kernel is
+    rotated by its internal augmenter), so state of global generator is
+    restored afterwards.
+    """
+    if rng is None:
+        return seq_other(images=images)
+    global_rng = ia.random.get_global_rng()
+    global_state = global_rng.state
+    images = seeded(make_other(), rng)(images=images)
+    global_rng.set_state_(global_state)
+    return images
+
+
+def augment_batch(image, keypoints, count, pyramid=False, rng=None):
+    """
+    Augment multiple copies of input image at once with two globaly
+    defined transformation seq_affine and seq_others. Whole batch is
+    processed by single call of each augmenter, which is much faster
+    than augmenting copies one by one.
 
     Args:
         image: image to be augmented
         keypoints: important points to be recalculated
+        count: number of augmented copies
+        pyramid: scale down copies from pyramid levels of image (see affine_batch)
+        rng: np.random.RandomState from which augmenters of this call are seeded,
+            global generators of numpy and imgaug are used if None
 
     Returns:
-        Augmented image and new positions of keypoints. 
+        List of (augmented image, new positions of keypoints) pairs. 
     """
-
     #Affine transformation has to applied to every channel.
     #Color variations apply only to color channels.
     #1. Augmentation of every channel in image
-    img_aug, points = augment(image, aug_obj=seq_affine, points_to_keep=keypoints)
+    with stage("augment"):
+        imgs_aug, points_aug = affine_batch(image, keypoints, count, pyramid, rng)
 
     #2. Augmentation without alpha channel
-    if img_aug.shape[2] == 4:
-        b, g, r, alpha = cv2.split(img_aug)
-        bgr_image = cv2.merge((b,g,r))
+    results = []
+    if image.shape[2] == 4:
+        #Color augmenters get only BGR view of affine output and result
+        #is written back into the same array, alpha channel stays untouched.
+        #Color augmenters do not move points.
+        with stage("augment"):
+            bgr_augs = color_batch([img_aug[:, :, :3] for img_aug in imgs_aug], rng)
+        for fully_aug, bgr_aug, point_aug in zip(imgs_aug, bgr_augs, points_aug):
+            fully_aug[:, :, :3] = bgr_aug
+
+            fully_aug, deleted_rows, deleted_columns = remove_empty_space(fully_aug)
+            points = fix_points(keypoints_to_points(point_aug), deleted_rows, deleted_columns)
+            results.append((fully_aug, points))
+    else:
+        with stage("augment"):
+            imgs_aug = color_batch(imgs_aug, rng)
+        for img_aug, point_aug in zip(imgs_aug, points_aug):
+            results.append((img_aug, keypoints_to_points(point_aug)))
+    return results
 
-        bgr_aug, points = augment(bgr_image, aug_obj=seq_other, points_to_keep=points)
-        fully_aug = cv2.merge((bgr_aug, alpha))
 
-        fully_aug, deleted_rows, deleted_columns = remove_empty_space(fully_aug)
-        points = fix_points(points, deleted_rows, deleted_columns)
-        
-        return fully_aug, points
-    else:
-        return augment(img_aug, aug_obj=seq_other, points_to_keep=points)
+def augment_img(image, keypoints, pyramid=False, rng=None):
+    """
+    Augment input image with two globaly defined transformation
+    seq_affine and seq_others.
+
+    Args:
+        image: image to be augmented
+        keypoints: important points to be recalculated
+
+    Returns:
+        Augmented image and new positions of keypoints. 
+    """
+    return augment_batch(image, keypoints, 1, pyramid, rng)[0]
 
 
 def normalize_size(image, points, max_w, max_h):
     """
    Normalize size of the image and based on that calculate
    new position of important points. The ratio of image sides 
-   is preserved.
+   is preserved. Final scale is computed once and image is
+   resized by single call (INTER_AREA), image is never upscaled.
 
     Args:
         image: image to be resized
@@ -168,27 +316,17 @@ def normalize_size(image, points, max_w, max_h):
     
     Returns:
         image: new resized image
-        new_points: list of points, with correct coordinates in new image
+        new_points: list of points, with correct (float) coordinates in new image
     """
     origin_w = image.shape[1]
     origin_h = image.shape[0]
-    ratio = origin_w / origin_h
-
-    if image.shape[1] > max_w:
-        img_w = image.shape[1]
-        img_h = image.shape[0]
+    scale = min(1, max_w / origin_w, max_h / origin_h)
 
-        dif = img_w - max_w
-        new_h =  img_h - int(dif / ratio)
-        image = cv2.resize(image, (max_w, new_h), interpolation=cv2.INTER_CUBIC)
-
-    if image.shape[0] > max_h:
-        img_w = image.shape[1]
-        img_h = image.shape[0]
-        
-        dif = img_h - max_h
-        new_w = img_w - int(dif * ratio)
-        image = cv2.resize(image, (new_w, max_h), interpolation=cv2.INTER_CUBIC)
+    if scale < 1:
+        res_w = min(max_w, max(1, round(origin_w * scale)))
+        res_h = min(max_h, max(1, round(origin_h * scale)))
+        with stage("normalize_size"):
+            image = cv2.resize(image, (res_w, res_h), interpolation=cv2.INTER_AREA)
 
     #calculate correct points position in new image
     res_w = image.shape[1]
@@ -196,50 +334,247 @@ def normalize_size(image, points, max_w, max_h):
     new_points = []
     
     for point in points:
-        new_x = (point[0] / origin_w) * res_w
-        new_y = (point[1] / origin_h) * res_h
-        new_points.append([int(new_x), int(new_y)])
+        new_x = point[0] * res_w / origin_w
+        new_y = point[1] * res_h / origin_h
+        new_points.append([new_x, new_y])
     
     return image, new_points
 
 
+def load_template(template_folder, image_data, max_w, max_h, cache=None, key=None):
+    """
+    Load sign template and normalize its size. Normalized template
+    is taken from cache (TemplateCache) if available.
+
+    Returns:
+        Normalized image and copy of template description with
+        recalculated points.
+    """
+    path = os.path.join(template_folder, image_data["filename"])
+    image_data = dict(image_data)
+    if cache is not None:
+        if key is None:
+            key = template_key(path, image_data["points"], max_w, max_h)
+        cached = cache.load(key)
+        if cached is not None:
+            norm_img, image_data["points"] = cached
+            return norm_img, image_data
+
+    temp_img = load_img(path, bgra=True)
+    norm_img, image_data["points"] = normalize_size(temp_img, image_data["points"], max_w, max_h)
+    if cache is not None:
+        cache.store(key, norm_img, image_data["points"])
+    return norm_img, image_data
+
+
+def remove_file(path):
+    # remove file if it exists
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def seed_rngs(seed):
+    """
+    Seed every random generator used during augmentation
+    (numpy global generator and imgaug global generator).
+    """
+    np.random.seed(seed)
+    ia.seed(seed)
+
+
+def augment_template(norm_img, image_data, start, stop, root_path, seed, writer=None, pyramid=False):
+    """
+    Create augmented copies of normalized sign template and store them.
+    Copies are augmented as a single batch, meanwhile writer threads
+    store images of previous batch. Writer is joined before images of
+    this batch are submitted, so images of previous batches are stored
+    when it returns. Images of this batch are stored after next call
+    (or after writer is joined).
+
+    Args:
+        norm_img: normalized template image
+        image_data: description of template (type, points, ...)
+        start, stop: range of indexes of augmented copies, index is 
+            used as name of new image
+        root_path: directory where augmented images are stored
+        seed: seed of this batch, same seed gives same result
+        writer: WriteBehind which stores images, images are stored 
+            directly if not set
+        pyramid: scale down copies from pyramid levels of template
+
+    Returns:
+        List of descriptions of augmented images with new filename and points.
+    """
+    if writer is None:
+        writer = WriteBehind(threads=0)
+    seed_rngs(seed)
+    records = []
+    augmented = augment_batch(norm_img, image_data["points"], stop - start, pyramid)
+    writer.join()
+    for idx, (img_aug, points) in zip(range(start, stop), augmented):
+        data = dict(image_data)
+        data["points"] = points
+
+        #store image in new file along with augmented points
+        data["filename"] = os.path.join(data["type"], str(idx + 1) + ".png")
+        writer.submit(store_img, os.path.join(root_path, data["filename"]), img_aug)
+        records.append(data)
+    record_queue("write", writer.pending())
+    return records
+
+
+# Normalized templates of worker process and barrier of all worker 
+# processes, set by init_worker. Records of last job of process which 
+# images are not stored yet are kept in _worker_pending.
+_worker_templates = None
+_worker_barrier = None
+_worker_pending = []
+
+def init_worker(templates, root_path, io_threads=0, pyramid=False, barrier=None):
+    global _worker_templates, _worker_barrier, _worker_pending
+    _worker_templates = (templates, root_path, WriteBehind(io_threads), pyramid)
+    _worker_barrier = barrier
+    _worker_pending = []
+
+
+def augment_job(job):
+    # Job for worker process, templates are shared by init_worker
+    # so only indexes are sent with every job. Records of job are
+    # returned by the next job of the same process (or by close_worker),
+    # when its images are stored. Statistics of process are returned
+    # along with records.
+    global _worker_pending
+    job_index, temp_index, start, stop, seed = job
+    templates, root_path, writer, pyramid = _worker_templates
+    norm_img, image_data = templates[temp_index]
+    records = augment_template(norm_img, image_data, start, stop, root_path, seed, writer, pyramid)
+    done, _worker_pending = _worker_pending, [(job_index, records)]
+    return done, take_stats()
+
+
+def close_worker(_):
+    # Last job of worker process, returns records of its last job after
+    # all images are stored. Workers wait for each other on barrier,
+    # so every worker gets exactly one of these jobs.
+    global _worker_pending
+    if _worker_barrier is not None:
+        _worker_barrier.wait()
+    _worker_templates[2].close()
+    done, _worker_pending = _worker_pending, []
+    return done, take_stats()
+
+
 def main():
     """
     Create proper directory structure for augmented images of sign templates.
     For each sign template generates number (specified by script argument "count")
     of uniqly augmented images.
+
+    Augmentations of template are split into batches (script argument "batch"),
+    every batch is separate job with its own seed. Jobs can be processed by 
+    multiple worker processes (script argument "workers").
+    Results are collected in the same order as jobs were created and
+    stored into data.json as soon as images of job are stored.
+
+    Key of every template (hash of template file, points and size) is stored
+    in templates_state.json. In incremental mode (script argument "incremental")
+    only templates with changed key or count are augmented, records of the
+    others are copied from previous data.json.
     """
 
     args = parse_arguments()
     root_path = args.dest
     templates_data = load_templates_structure(args.temp_data)
     template_folder = args.src
-    aug_count = args.count
-    aug_structure = []
+    targets = load_targets(args.targets) if args.targets is not None else {}
     max_width = args.max_w
     max_height = args.max_h
 
+    cache = TemplateCache(args.cache) if args.cache is not None else None
+    state_path = os.path.join(root_path, "templates_state.json")
+    data_path = os.path.join(root_path, "data.json")
+    old_state = {}
+    if args.incremental and os.path.isfile(state_path) and os.path.isfile(data_path):
+        with open(state_path, "r") as state_file:
+            old_state = json.load(state_file)
+
+    state = {}
+    templates = []
     for temp_index, image_data in enumerate(templates_data):
+        key = template_key(os.path.join(template_folder, image_data["filename"]),
+                           image_data["points"], max_width, max_height)
+        state[image_data["type"]] = {"key": key, "count": targets.get(image_data["type"], args.count)}
+        if old_state.get(image_data["type"]) == state[image_data["type"]]:
+            # template did not change, keep its augmented images
+            templates.append(None)
+            continue
         
         #generate directory and load template image
-        type_dir_path = gen_template_dir(root_path, image_data["type"])
-        temp_img = load_img(os.path.join(template_folder, image_data["filename"]), bgra=True)
-        norm_img, image_data["points"] = normalize_size(temp_img, image_data["points"], max_width, max_height)
-
-        print("Augmentation of ", temp_index+1, "\\", len(templates_data))
-        for idx in range(aug_count):
-            #aug_count = number of create augmentations for single sign template
-            data = copy.deepcopy(image_data)
-            img_aug, data["points"] = augment_img(norm_img, data["points"])
-
-            #store image in new file along with augmented points
-            data["filename"] = os.path.join(data["type"], str(idx + 1) + ".png")
-            store_img(os.path.join(root_path, data["filename"]), img_aug)
-            aug_structure.append(data)
-
-    #store structure 
-    store_templates_structure(os.path.join(root_path + "data.json"), aug_structure)
+        gen_template_dir(root_path, image_data["type"])
+        templates.append(load_template(template_folder, image_data, max_width, max_height, cache, key))
+    unchanged = set(temp_type for temp_type in state if old_state.get(temp_type) == state[temp_type])
+
+    #count = number of create augmentations for single sign template
+    counts = [state[image_data["type"]]["count"] for image_data in templates_data]
+    jobs = [(temp_index, start, min(start + args.batch, counts[temp_index]))
+            for temp_index in range(len(templates)) for start in range(0, counts[temp_index], args.batch)]
+    seeds = np.random.RandomState(args.seed).randint(0, 2**31 - 1, size=len(jobs))
+    jobs = [job + (seed,) for job, seed in zip(jobs, seeds) if templates[job[0]] is not None]
+    jobs = [(job_index,) + job for job_index, job in enumerate(jobs)]
+
+    profiler = Profiler("Augmentation", total=sum(job[3] - job[2] for job in jobs))
+    profiler.merge(take_stats())
+    if args.workers > 1:
+        barrier = Barrier(args.workers)
+        pool = Pool(args.workers, initializer=init_worker,
+                    initargs=(templates, root_path, args.io_threads, args.pyramid, barrier))
+        results = itertools.chain(pool.imap(augment_job, jobs),
+                                  pool.imap(close_worker, range(args.workers)))
+    else:
+        pool = None
+        init_worker(templates, root_path, args.io_threads, args.pyramid)
+        results = itertools.chain(map(augment_job, jobs), map(close_worker, [None]))
+
+    #store structure, in incremental mode previous data.json is
+    #replaced after all templates are augmented
+    new_data_path = data_path + ".tmp" if args.incremental else data_path
+    if not args.incremental:
+        #state describes data.json which is overwritten now, without it
+        #crashed run is not taken as complete by next incremental run
+        remove_file(state_path)
+    with TemplatesStructureWriter(new_data_path) as aug_structure:
+        if len(unchanged) > 0:
+            for data in iter_templates_structure(data_path):
+                if data["type"] in unchanged:
+                    aug_structure.write(data)
+
+        #records of job are written when records of all previous jobs are
+        finished = {}
+        next_job = 0
+        for done, stats in results:
+            finished.update(done)
+            count = 0
+            while next_job in finished:
+                records = finished.pop(next_job)
+                for data in records:
+                    aug_structure.write(data)
+                count += len(records)
+                next_job += 1
+            profiler.update(count, stats)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    if new_data_path != data_path:
+        remove_file(state_path)
+        os.replace(new_data_path, data_path)
+    with open(state_path, "w") as state_file:
+        json.dump(state, state_file)
+    profiler.finish(args.stats)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+##########################
+#
+# Author: Andrej Panicek
+# Desc  : Generate both datasets in single run, without storing
+#         background crops and augmented templates.
+#
+##########################
+import os
+import argparse
+import itertools
+import numpy as np
+from collections import deque
+
+from templates_utils import load_templates_structure
+from img_utils import REDUCED_COLOR, sample_crop_positions
+from dataset_generator import DatasetGenerator, GT_FORMATS, IMAGE_FORMATS
+from generate_ran_bg import list_dir_files, load_road_img
+from generate_aug_tmp import load_template, augment_batch
+from template_cache import TemplateCache
+from insert_templates_to_bg import insert_signs, write_committed
+from sample_manifest import SampleManifestWriter, iter_samples, parse_samples
+from profiler import Profiler
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bg', required=True, help='Path to directory with road images (without signs).')
+    parser.add_argument('--src', required=True, help='Path to sign templates directory.')
+    parser.add_argument('--temp_data', required=True, help='Path to json file which contains description about each sign.')
+    parser.add_argument('--det_dataset', required=True, help='Path where to store images for detection dataset.')
+    parser.add_argument('--cls_dataset', required=True, help='Path where to store images for clasification dataset.')
+    parser.add_argument('--count', type=int, required=True, help='How many augmented images create from each sign.')
+    parser.add_argument('--max_w', type=int, required=True, help='Maximum width of sign.')
+    parser.add_argument('--max_h', type=int, required=True, help='Maximum height of sign.')
+    parser.add_argument('--width', type=int, required=True, help='Width of background images.')
+    parser.add_argument('--height', type=int, required=True, help="Height of background images.")
+    parser.add_argument('--per_bg', type=int, default=100, help='How many samples crop from each decoded road image (default 100).')
+    parser.add_argument('--reduce', type=int, default=1, choices=sorted(REDUCED_COLOR), help='Decode road images in 1/reduce of their resolution (default 1).')
+    parser.add_argument('--objects', type=int, default=1, help='How many signs insert into each image of detection dataset (default 1).')
+    parser.add_argument('--cache', default=None, help='Path to directory with cache of normalized templates.')
+    parser.add_argument('--pyramid', action='store_true', help='Scale down templates from precomputed pyramid levels instead of full size template.')
+    parser.add_argument('--gt_format', default="txt", choices=GT_FORMATS, help='Ground truth format, txt file for every image or single csv file (default txt).')
+    parser.add_argument('--image_format', default="jpg", choices=IMAGE_FORMATS, help='Image storage, jpg file for every image or tar shards (default jpg).')
+    parser.add_argument('--shard_size', type=int, default=1000, help='Number of images in single tar shard (default 1000).')
+    parser.add_argument('--gt_flush', type=int, default=1000, help='Commit images into dataset manifest after this many images (default 1000).')
+    parser.add_argument('--io_threads', type=int, default=0, help='Number of threads which encode and store images of each dataset (default 0).')
+    parser.add_argument('--seed', type=int, default=None, help='Base seed of random generators, random if not set.')
+    parser.add_argument('--manifest', default=None, help='Path to manifest (json record on every line) where seed and placement of every sample is appended.')
+    parser.add_argument('--replay', default=None, help='Path to manifest, generate again samples from it instead of new samples.')
+    parser.add_argument('--samples', default=None, help='Which samples of replayed manifest generate, e.g. "0-99,150" (default all).')
+    parser.add_argument('--stats', default=None, help='Path to json file where statistics of run (stage timings, samples per second) are stored.')
+    args = parser.parse_args()
+    return args
+
+
+def background_stage(paths, per_bg, reduce=1, rng=None):
+    """
+    Endless stream of decoded road images. Road images are used in
+    random order (rng), every decoded image is provided for per_bg samples.
+
+    Yields:
+        Path of road image and the image, image must not be modified.
+    """
+    if len(paths) == 0:
+        raise ValueError("No road images to crop backgrounds from")
+    if per_bg < 1:
+        raise ValueError("Number of crops (" + str(per_bg) + ") of road image has to be positive")
+    rng = np.random if rng is None else rng
+    while True:
+        for path in rng.permutation(paths):
+            road_img = load_road_img(path, reduce)
+            for _ in range(per_bg):
+                yield path, road_img
+
+
+def replay_stage(records, road_dir, reduce=1):
+    """
+    Stream of road images of replayed samples, consecutive samples
+    of the same road image share decoded image.
+
+    Yields:
+        Path of road image, the image and record of sample.
+    """
+    road_path, road_img = None, None
+    for _, record in records:
+        if os.path.join(road_dir, record["road"]) != road_path:
+            road_path = os.path.join(road_dir, record["road"])
+            road_img = load_road_img(road_path, reduce)
+        yield road_path, road_img, record
+
+
+def group_stage(items, size):
+    # Split stream into lists of given size.
+    if size < 1:
+        raise ValueError("Size of group has to be positive, not " + str(size))
+    items = iter(items)
+    while True:
+        group = list(itertools.islice(items, size))
+        if len(group) == 0:
+            return
+        yield group
+
+
+def generate_sample(road_path, road_img, templates, temp_indexes, seed, width, height,
+                    class_dataset, detection_dataset, pyramid=False):
+    """
+    Create samples of both datasets from random crop of road image.
+    Crop, augmentation of templates and placement of signs are driven
+    only by random generator seeded by seed of sample, so the same seed,
+    road image and templates give the same samples. Copies of the same
+    template are augmented by single call.
+
+    Args:
+        road_path, road_img: path of road image and the image
+        templates: normalized templates with their descriptions
+        temp_indexes: indexes of templates inserted into sample
+
+    Returns:
+        Record of sample for manifest, seed and placement.
+    """
+    rng = np.random.RandomState(seed)
+    crop_x, crop_y = sample_crop_positions(road_img.shape, width, height, rng=rng)
+    bg_img = road_img[crop_y:crop_y + height, crop_x:crop_x + width]
+
+    augmented = {}
+    for temp_index in dict.fromkeys(temp_indexes):
+        norm_img, image_data = templates[temp_index]
+        copies = augment_batch(norm_img, image_data["points"], temp_indexes.count(temp_index), pyramid, rng)
+        augmented[temp_index] = copies[::-1]
+    temp_imgs = []
+    temps = []
+    for temp_index in temp_indexes:
+        temp_img, points = augmented[temp_index].pop()
+        data = dict(templates[temp_index][1])
+        data["points"] = points
+        temp_imgs.append(temp_img)
+        temps.append(data)
+
+    record = {"seed": int(seed), "road": os.path.basename(road_path), "crop": [int(crop_x), int(crop_y)],
+              "templates": [temp["filename"] for temp in temps], "types": [temp["type"] for temp in temps]}
+    record.update(insert_signs(bg_img, temp_imgs, temps, class_dataset, detection_dataset, rng))
+    return record
+
+
+def generate_dataset():
+    """
+    Chain generation of background images, augmentation of templates
+    and insertion of templates into backgrounds. Every stage passes
+    images in memory to the next one, only the final datasets are stored.
+
+    Every sample (image of detection dataset with its classification images)
+    has own seed, which drives crop of road image, augmentation and placement
+    of its signs. Seed, road image, templates and placement of sample are
+    stored in manifest (script argument "manifest") when its images are
+    committed. Samples of manifest can be generated again from road images
+    and templates (script arguments "replay" and "samples"), other script
+    arguments have to be the same as in the original run.
+    """
+    args = parse_arguments()
+
+    cache = TemplateCache(args.cache) if args.cache is not None else None
+    templates_data = load_templates_structure(args.temp_data)
+    templates = [load_template(args.src, image_data, args.max_w, args.max_h, cache)
+                 for image_data in templates_data]
+
+    if args.replay is not None:
+        samples = parse_samples(args.samples) if args.samples is not None else None
+        # the first template of given filename is used
+        temp_index = {}
+        for index, image_data in enumerate(templates_data):
+            temp_index.setdefault(image_data["filename"], index)
+        jobs = ((road_path, road_img, [temp_index[name] for name in record["templates"]], record["seed"])
+                for road_path, road_img, record in replay_stage(iter_samples(args.replay, samples), args.bg, args.reduce))
+        profiler = Profiler("Replay", total=len(samples) if samples is not None else None)
+    else:
+        # every template is inserted count times, signs of sample are consecutive
+        seeds = np.random.RandomState(args.seed)
+        backgrounds = background_stage(list_dir_files(args.bg), args.per_bg, args.reduce,
+                                       np.random.RandomState(seeds.randint(0, 2**31 - 1)))
+        signs = (temp_index for temp_index in range(len(templates)) for _ in range(args.count))
+        jobs = (next(backgrounds) + (temp_indexes, seeds.randint(0, 2**31 - 1))
+                for temp_indexes in group_stage(signs, args.objects))
+        profiler = Profiler("Progress", total=len(templates) * args.count)
+
+    manifest = SampleManifestWriter(args.manifest) if args.manifest is not None else None
+    records = deque()
+    with DatasetGenerator(args.cls_dataset, args.gt_format, args.gt_flush, args.image_format,
+                          args.shard_size, io_threads=args.io_threads) as class_dataset, \
+         DatasetGenerator(args.det_dataset, args.gt_format, args.gt_flush, args.image_format,
+                          args.shard_size, io_threads=args.io_threads) as detection_dataset:
+
+        for road_path, road_img, temp_indexes, seed in jobs:
+            record = generate_sample(road_path, road_img, templates, temp_indexes, seed, args.width, args.height,
+                                     class_dataset, detection_dataset, args.pyramid)
+            if manifest is not None:
+                records.append(record)
+                write_committed(records, manifest, class_dataset, detection_dataset)
+            profiler.update(1 if args.replay is not None else len(temp_indexes))
+
+    if manifest is not None:
+        # all images are committed by close
+        write_committed(records, manifest, class_dataset, detection_dataset)
+        manifest.close()
+    profiler.finish(args.stats)
+
+
+if __name__ == "__main__":
+    generate_dataset()
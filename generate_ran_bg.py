@@ -10,8 +10,11 @@ import os
 import cv2
 import numpy as np
 import argparse
+from multiprocessing import Pool, Barrier
 
-from img_utils import load_img, show_img, store_img
+from img_utils import load_img, show_img, store_img, sample_crop_positions, REDUCED_COLOR
+from write_behind import WriteBehind
+from profiler import Profiler, record_queue, take_stats
 
 def parse_arguments():
     parser = argparse.ArgumentParser()
@@ -20,13 +23,18 @@ def parse_arguments():
     parser.add_argument('--amount', type=int, required=True, help='Total amount of generated images.')
     parser.add_argument('--width', type=int, required=True, help='Width of new images.')
     parser.add_argument('--height', type=int, required=True, help="Height of new images.")
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker processes (default 1, no pool).')
+    parser.add_argument('--reduce', type=int, default=1, choices=sorted(REDUCED_COLOR), help='Decode background images in 1/reduce of their resolution, crops are taken from reduced image (default 1).')
+    parser.add_argument('--io_threads', type=int, default=0, help='Number of threads which encode and store crops, 0 stores crops in main thread (default 0).')
+    parser.add_argument('--seed', type=int, default=None, help='Base seed of random generators, random if not set.')
+    parser.add_argument('--stats', default=None, help='Path to json file where statistics of run (stage timings, samples per second) are stored.')
     args = parser.parse_args()
     return args
 
 
 def list_dir_files(path: str):
-    #return list of all files in directory specified by path
-    return [os.path.abspath(path + f) for f in os.listdir(path) if os.path.isfile(path + f)] 
+    #return sorted list of all files in directory specified by path
+    return [os.path.abspath(path + f) for f in sorted(os.listdir(path)) if os.path.isfile(path + f)] 
 
 
 def generate_dir(path):
@@ -39,35 +47,78 @@ def generate_dir(path):
     return path
 
 
-def gen_pos_in_img(img_shape, top_pos=0.5):
-    if np.random.uniform(low=0, high=1) < top_pos:
-        rand_y = np.random.randint(low=0, high=img_shape[1]/2)
-    else:
-        rand_y = np.random.randint(low=img_shape[1]/2, high=img_shape[1])
+# Writer of process and barrier of all worker processes, set by init_worker.
+_writer = None
+_barrier = None
+
+def init_worker(io_threads, barrier=None):
+    global _writer, _barrier
+    _writer = WriteBehind(io_threads)
+    _barrier = barrier
+
+
+def close_worker(_):
+    """
+    Last job of worker process, waits until all crops of process are 
+    stored. Workers wait for each other on barrier, so every worker 
+    gets exactly one of these jobs.
+
+    Returns:
+        Statistics of process (take_stats).
+    """
+    if _barrier is not None:
+        _barrier.wait()
+    _writer.close()
+    return take_stats()
+
+
+def load_road_img(path, reduce=1):
+    # Load road image without black part at the bottom.
+    bg_img = load_img(path, reduce=reduce)
+    return bg_img[0:bg_img.shape[0] - 1000 // reduce, 0:bg_img.shape[1]]
+
+
+def random_crops(bg_img, width, height, count):
+    """
+    Generate positions of all crops at once.
+
+    Returns:
+        List of crops, every crop is view of bg_img.
+    """
+    positions = sample_crop_positions(bg_img.shape, width, height, count)
+    return [bg_img[pos_y:pos_y + height, pos_x:pos_x + width] for pos_x, pos_y in positions]
 
-    rand_x = np.random.randint(low=0, high=img_shape[0])
-    return [rand_x, rand_y]
 
-    
-def crop_random_part(image, width, height):
+def crop_bg_image(job):
     """
-    Crop part of image with size specified by args.
-    Coordinates generate randomly.
-    
+    Create all crops from single background image. Every job seeds
+    its own random generator, so result does not depend on which
+    worker process handles the job.
+
+    Image is decoded once and positions of all crops are generated 
+    at once. Encoding and storing of crops is done by writer threads
+    of process (cv2 releases GIL during encoding), they keep storing
+    crops while next job is processed. Crops are stored when
+    close_worker() returns.
+
     Args:
-        image: crop this image
-        width: width of crop
-        height: height of crop
+        job: tuple (bg_path, dest_dir, first_index, count, width, height, seed,
+            reduce), crops are stored as first_index.jpg ... 
+            (first_index + count - 1).jpg
     Returns:
-        Created crop as new image.
+        Number of submitted crops and statistics of process (take_stats).
     """
-    
-    x = image.shape[1]
-    y = image.shape[0]
-    while (x + width > image.shape[1]) or (y + height > image.shape[0]): 
-        x, y = gen_pos_in_img([image.shape[1], image.shape[0]], 0.25)
-    
-    return image[y:y + height, x:x + width]
+    bg_path, dest_dir, first_index, count, width, height, seed, reduce = job
+    np.random.seed(seed)
+
+    bg_img = load_road_img(bg_path, reduce)
+    paths = [os.path.join(dest_dir, str(first_index + x) + ".jpg") for x in range(count)]
+    crops = random_crops(bg_img, width, height, count)
+
+    for path, cropped in zip(paths, crops):
+        _writer.submit(store_img, path, cropped)
+    record_queue("write", _writer.pending())
+    return count, take_stats()
 
 
 def generate_rand_bg():
@@ -76,6 +127,10 @@ def generate_rand_bg():
     certain number of samples. The number is calculated as 
     desired size of dataset(specified by modul argument --amount)
     devided by number of images that are available.
+
+    Names of new images are assigned before generation starts,
+    so background images can be processed by multiple worker 
+    processes (specified by modul argument --workers).
     """
     args = parse_arguments()
 
@@ -93,25 +148,32 @@ def generate_rand_bg():
 
     desired_number_of_samples = args.amount
     per_bg = int(desired_number_of_samples/len(background_imgs))
+    total = per_bg * len(background_imgs)
 
+    # Every background image gets its own range of names and its own seed.
+    seeds = np.random.RandomState(args.seed).randint(0, 2**31 - 1, size=len(background_imgs))
+    jobs = []
     for idx, bg_path in enumerate(background_imgs):
-        # Iterates over dataset of road background images without signs
-        # and from each one of them create multiple random crops.
-        bg_img = load_img(bg_path)
-
-        #get rid of black part 
-        bg_img = bg_img[0:bg_img.shape[0] - 1000, 0:bg_img.shape[1]]
-        
-        for x in range(per_bg):
-            curr = per_bg * (idx) + x
-            total = per_bg * len(background_imgs)
-            print("Working on", curr, "/", total)
-            cropped = crop_random_part(bg_img, new_size_w, new_size_h)
-
-            name = str(gen_count) + ".jpg"
-            path = os.path.join(new_bg_dir, name)
-            store_img(path, cropped)
-            gen_count += 1
+        first_index = gen_count + per_bg * idx
+        jobs.append((bg_path, new_bg_dir, first_index, per_bg, new_size_w, new_size_h, seeds[idx], args.reduce))
+
+    profiler = Profiler("Working on", total=total)
+    if args.workers > 1:
+        barrier = Barrier(args.workers)
+        with Pool(args.workers, initializer=init_worker, initargs=(args.io_threads, barrier)) as pool:
+            for count, stats in pool.imap_unordered(crop_bg_image, jobs):
+                profiler.update(count, stats)
+            for stats in pool.map(close_worker, range(args.workers), chunksize=1):
+                profiler.merge(stats)
+    else:
+        init_worker(args.io_threads)
+        for job in jobs:
+            # Iterates over dataset of road background images without signs
+            # and from each one of them create multiple random crops.
+            count, stats = crop_bg_image(job)
+            profiler.update(count, stats)
+        profiler.merge(close_worker(None))
+    profiler.finish(args.stats)
             
 
 if __name__ == "__main__":
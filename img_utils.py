@@ -6,19 +6,39 @@
 ##########################  
 import os
 import cv2
+import numpy as np
 
-def load_img(path, bgra=False):
-    if bgra:
-        image = cv2.imread(path, cv2.IMREAD_UNCHANGED)
-    else:
-        image = cv2.imread(path)
+from profiler import stage
+
+# Flags for decoding of color image in reduced resolution.
+REDUCED_COLOR = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+def load_img(path, bgra=False, reduce=1):
+    # reduce - decode color image in 1/reduce of its resolution (1, 2, 4 or 8)
+    with stage("decode"):
+        if bgra:
+            image = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+        else:
+            image = cv2.imread(path, REDUCED_COLOR[reduce])
     if image is None or image.size == 0:
         raise Exception("Loading image", path, "failed")
     return image
 
 
 def store_img(path, image):
-    cv2.imwrite(path, image)
+    # format is given by extension of path
+    with stage("encode"):
+        success, data = cv2.imencode(os.path.splitext(path)[1], image)
+    if not success:
+        raise Exception("Encoding image", path, "failed")
+    with stage("write"):
+        with open(path, "wb") as img_file:
+            img_file.write(data)
 
 
 def show_img(image, desc):
@@ -30,4 +50,109 @@ def show_img(image, desc):
 def draw_points(image, points):
     for edge in points:
         new_image = cv2.circle(image, (edge[0], edge[1]), 3, (0,255,0), 3)
-    return new_image
\ No newline at end of file
+    return new_image
+
+
+def alpha_blend(bg_image, fg_image, coords):
+    """
+    Blend image with alpha channel (BGRA) into background image (BGR)
+    in place. Parts of foreground outside of background are clipped.
+
+    Args:
+        bg_image: background image, it is modified
+        fg_image: foreground image with alpha channel
+        coords: [x, y] position of top left corner of foreground in background
+
+    Returns:
+        Bounding box of visible part of foreground [x_start, y_start, x_end, y_end],
+        None if foreground is completely outside of background.
+    """
+    x, y = int(coords[0]), int(coords[1])
+    bg_h, bg_w = bg_image.shape[:2]
+    fg_h, fg_w = fg_image.shape[:2]
+
+    x_start, y_start = max(x, 0), max(y, 0)
+    x_end, y_end = min(x + fg_w, bg_w), min(y + fg_h, bg_h)
+    if x_start >= x_end or y_start >= y_end:
+        return None
+
+    with stage("composite"):
+        region = bg_image[y_start:y_end, x_start:x_end]
+        fg = fg_image[y_start - y:y_end - y, x_start - x:x_end - x]
+
+        alpha = fg[:, :, 3:4].astype(np.uint16)
+        blended = fg[:, :, :3] * alpha
+        blended += region * (255 - alpha)
+        blended += 127
+        blended //= 255
+        region[...] = blended
+    return [x_start, y_start, x_end, y_end]
+
+
+def sample_crop_positions(img_shape, width, height, count=None, top_pos=0.25, rng=None):
+    """
+    Generate random positions of crops, so every crop is whole inside 
+    of image. Positions are sampled directly from valid region.
+
+    In our real life dataset, signs usually dont appear in the top portion
+    of the image. The top half of image is chosen with probability top_pos,
+    then position is uniform in it. Only valid positions are considered, 
+    so the distribution is the same as generating positions in whole image 
+    and rejecting those where crop does not fit.
+
+    Args:
+        img_shape: shape of image (height, width, ...)
+        width: width of crop
+        height: height of crop
+        count: number of generated positions, if None single position is generated
+        top_pos: can be from interval <0,1> (0 meaning position will be
+            in bottom half of the image)
+        rng: np.random.RandomState, global numpy generator if None
+    Returns:
+        [x, y] position of top left corner of crop, or array of shape (count, 2) 
+        if count is specified.
+    """
+    rng = np.random if rng is None else rng
+    img_h, img_w = img_shape[:2]
+    if width <= 0 or height <= 0 or width > img_w or height > img_h:
+        raise ValueError("Crop of size " + str((width, height)) + " does not fit into image of size " + str((img_w, img_h)))
+
+    half = img_h // 2
+    max_y = img_h - height
+    # number of valid rows in top and bottom half of image
+    top_rows = min(half, max_y + 1)
+    bottom_rows = max(0, max_y + 1 - half)
+
+    top_weight = top_pos * top_rows / half if half > 0 else 0
+    bottom_weight = (1 - top_pos) * bottom_rows / (img_h - half)
+    if top_weight + bottom_weight == 0:
+        raise ValueError("Crop of height " + str(height) + " can not be placed with top_pos " + str(top_pos))
+
+    size = 1 if count is None else count
+    in_top = rng.uniform(low=0, high=1, size=size) < top_weight / (top_weight + bottom_weight)
+    y = np.where(in_top,
+                 rng.randint(0, max(top_rows, 1), size=size),
+                 half + rng.randint(0, max(bottom_rows, 1), size=size))
+    x = rng.randint(0, img_w - width + 1, size=size)
+
+    positions = np.stack((x, y), axis=1)
+    if count is None:
+        return positions[0].tolist()
+    return positions
+
+
+def crop_random_part(image, width, height, top_pos=0.25, rng=None):
+    """
+    Crop part of image with size specified by args.
+    Coordinates generate randomly.
+    
+    Args:
+        image: crop this image
+        width: width of crop
+        height: height of crop
+        rng: np.random.RandomState, global numpy generator if None
+    Returns:
+        Created crop as view of image.
+    """
+    x, y = sample_crop_positions(image.shape, width, height, top_pos=top_pos, rng=rng)
+    return image[y:y + height, x:x + width]
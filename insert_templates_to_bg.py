@@ -9,13 +9,16 @@ import numpy as np
 import os 
 import argparse
 import cv2
-from PIL import Image, ImageDraw
-from copy import deepcopy
-from random import shuffle
+from collections import deque
 
 from templates_utils import load_templates_structure
-from img_utils import load_img, show_img
-from DatasetGenerator import DatasetGenerator
+from img_utils import load_img, show_img, alpha_blend, sample_crop_positions
+from dataset_generator import DatasetGenerator, GT_FORMATS, IMAGE_FORMATS
+from background_pool import BackgroundPool, POLICIES
+from placement import place_objects
+from profiler import Profiler
+from sample_manifest import SampleManifestWriter, iter_samples, parse_samples
+from class_scheduler import load_targets, schedule
 
 def parse_arguments():
     parser = argparse.ArgumentParser()
@@ -23,12 +26,31 @@ def parse_arguments():
     parser.add_argument('--template', required=True, help='Path to directory with template sign images.')
     parser.add_argument('--det_dataset', required=True, help='Path where to store images for detection dataset.')
     parser.add_argument('--cls_dataset', required=True, help='Path where to store images for clasification dataset.')
+    parser.add_argument('--gt_format', default="txt", choices=GT_FORMATS, help='Ground truth format, txt file for every image or single csv file (default txt).')
+    parser.add_argument('--image_format', default="jpg", choices=IMAGE_FORMATS, help='Image storage, jpg file for every image or tar shards (default jpg).')
+    parser.add_argument('--shard_size', type=int, default=1000, help='Number of images in single tar shard (default 1000).')
+    parser.add_argument('--objects', type=int, default=1, help='How many signs insert into each image of detection dataset (default 1).')
+    parser.add_argument('--bg_reuse', type=int, default=1, help='How many times use each background image (default 1).')
+    parser.add_argument('--bg_policy', default="sequential", choices=POLICIES, help='Order in which background images are used (default sequential).')
+    parser.add_argument('--bg_cache', type=int, default=64, help='How many decoded background images keep in memory (default 64).')
+    parser.add_argument('--shared', action='store_true', help='Datasets can be filled by multiple processes at the same time.')
+    parser.add_argument('--parts', type=int, default=1, help='Split templates into this many parts, for multiple processes (default 1).')
+    parser.add_argument('--part', type=int, default=0, help='Which part of templates process, from interval <0, parts) (default 0).')
+    parser.add_argument('--io_threads', type=int, default=0, help='Number of threads which encode and store images of each dataset, 0 stores images in main thread (default 0).')
+    parser.add_argument('--stats', default=None, help='Path to json file where statistics of run (stage timings, samples per second) are stored.')
+    parser.add_argument('--targets', default=None, help='Path to json file with target number of samples of every sign type {"type": count}, only missing samples are generated.')
+    parser.add_argument('--target', type=int, default=None, help='Target number of samples of every sign type, only missing samples are generated.')
+    parser.add_argument('--seed', type=int, default=None, help='Base seed of random generators, random if not set.')
+    parser.add_argument('--manifest', default=None, help='Path to manifest (json record on every line) where seed and placement of every sample is appended.')
+    parser.add_argument('--replay', default=None, help='Path to manifest, generate again samples from it instead of new samples.')
+    parser.add_argument('--samples', default=None, help='Which samples of replayed manifest generate, e.g. "0-99,150" (default all).')
+    parser.add_argument('--gt_flush', type=int, default=1000, help='Commit images into dataset manifest and write buffered csv ground truths after this many images (default 1000).')
     args = parser.parse_args()
     return args
 
 
 def list_dir_files(path):
-   return [os.path.abspath(path + f) for f in os.listdir(path) if os.path.isfile(path + f)] 
+   return [os.path.abspath(path + f) for f in sorted(os.listdir(path)) if os.path.isfile(path + f)] 
 
 
 def load_temp(path: str):
@@ -37,26 +59,23 @@ def load_temp(path: str):
     return template_aug_structure 
 
 
-def load_bg(path: str):
-    #load background structure
+def load_bg(path: str, seed=None):
+    #load background structure, order is shuffled by seed
     background_imgs = list_dir_files(path)
-    shuffle(background_imgs)
+    np.random.RandomState(seed).shuffle(background_imgs)
 
     return background_imgs
 
 
-def insert_template(bg_image, temp_image, coords):
-    return bg_image + temp_image
-
-
 def add_aug_signs(bg_image, temp_img, coords, out_of_img=0):
     """
-    Add sign template into image of road background.
+    Add sign template into image of road background. Sign is blended
+    into background in place.
 
     Args:
-        bg_image: background image
-        temp_img: sign template image 
-        coords:
+        bg_image: background image (BGR)
+        temp_img: sign template image (BGRA)
+        coords: [x, y] position of top left corner of sign in background
         out_of_img: how big partion of sign can outside of image
             interval <0 = none, 1 = whole sign can be out>
     """
@@ -64,10 +83,10 @@ def add_aug_signs(bg_image, temp_img, coords, out_of_img=0):
     if out_of_img > 1 or out_of_img < 0:
         raise RuntimeError("Wrong usage of \"out_of_image\" parameter. Valid values are between <0,1>")
     
-    temp_width, temp_height = temp_img.size
+    temp_height, temp_width = temp_img.shape[:2]
 
-    out_x = max(0, coords[0] + temp_width - (bg_image.size)[0])
-    out_y = max(0, coords[1] + temp_height - (bg_image.size)[1])
+    out_x = max(0, coords[0] + temp_width - bg_image.shape[1])
+    out_y = max(0, coords[1] + temp_height - bg_image.shape[0])
 
     if out_of_img != 0:
         valid_out_x = int(temp_width * out_of_img)
@@ -83,60 +102,108 @@ def add_aug_signs(bg_image, temp_img, coords, out_of_img=0):
     coords[0] += move_x
     coords[1] += move_y
 
-    bg_image.paste(temp_img, coords, temp_img)
-    bbox = coords
+    alpha_blend(bg_image, temp_img, coords)
+    bbox = [coords[0], coords[1], coords[0] + temp_width, coords[1] + temp_height]
 
     return bg_image, bbox
 
 
-def crop_random_part(image, width, height):
+def insert_signs(bg_img, temp_imgs, temps, class_dataset, detection_dataset, rng=None):
     """
-    Crop part of image with size specified by args.
-    Coordinates generate randomly.
+    Create samples of both datasets from single background image.
+    Each sign is inserted into its own crop of background for 
+    classification dataset and all signs are inserted into single
+    copy of background for detection dataset.
 
-    It's actually the same implementation as in generate_ran_bg.py
-    module. Only here I use Pillow Image object instead of Opencv 
-    image object. 
-    
     Args:
-        image: crop this image
-        width: width of crop
-        height: height of crop
-    Returns:
-        Created crop as new image.
-    """ 
+        bg_img: background image, it is not modified
+        temp_imgs: augmented sign images
+        temps: descriptions of signs (type, ...)
+        rng: np.random.RandomState of crops and placement, global numpy
+            generator if None
 
-    x = image.size[0]
-    y = image.size[1]
-    while (x + width > image.size[0]) or (y + height > image.size[1]): 
-        x, y = gen_pos_in_img(image.size, 0.25)
-    
-    return image.crop((x, y, x + width, y + height))
+    Returns:
+        Placement parameters: indexes of classification images ("cls"),
+        positions of their crops in background ("crops"), index of 
+        detection image ("det", None if no sign fits into background)
+        and positions of signs in it ("positions").
+    """
+    # classification dataset, one sign in each image
+    cls_indexes = []
+    crops = []
+    for temp, temp_img in zip(temps, temp_imgs):
+        temp_height, temp_width = temp_img.shape[:2]
+        width_offset = int(temp_width * 0.08)
+        height_offset = int(temp_height * 0.08)
 
+        # only cropped part is copied
+        crop_w, crop_h = temp_width + width_offset + 1, temp_height + height_offset + 1
+        crop_x, crop_y = sample_crop_positions(bg_img.shape, crop_w, crop_h, rng=rng)
+        bg_for_cls_dataset = bg_img[crop_y:crop_y + crop_h, crop_x:crop_x + crop_w].copy()
+        image, bbox = add_aug_signs(bg_for_cls_dataset, temp_img, [int(width_offset/2), int(height_offset/2)])
+        cls_indexes.append(class_dataset.add_image(image, bbox, temp["type"]))
+        crops.append([int(crop_x), int(crop_y)])
+
+    # detection dataset, all signs in single image
+    bg_for_det_dataset = bg_img.copy()
+    positions = place_objects(bg_for_det_dataset.shape, [temp_img.shape for temp_img in temp_imgs], rng=rng)
+    bboxes = []
+    sign_types = []
+    for temp, temp_img, pos in zip(temps, temp_imgs, positions):
+        if pos is None:
+            # no free space left in image
+            continue
+        image, bbox = add_aug_signs(bg_for_det_dataset, temp_img, pos)
+        bboxes.append(bbox)
+        sign_types.append(temp["type"])
+    det_index = None
+    if len(bboxes) > 0:
+        # image without any sign would have no ground truth
+        det_index = detection_dataset.add_objects(bg_for_det_dataset, bboxes, sign_types)
+
+    positions = [None if pos is None else [int(pos[0]), int(pos[1])] for pos in positions]
+    return {"cls": cls_indexes, "crops": crops, "det": det_index, "positions": positions}
+
+
+def insert_sample(bg_path, bg_img, temp_files, sign_types, seed, template_dir,
+                  class_dataset, detection_dataset):
+    """
+    Create samples of both datasets from single background image,
+    random generator of sample is seeded by its seed, so the same
+    seed, background and signs give the same samples.
 
-def gen_pos_in_img(img_shape, top_pos=0.5):
+    Returns:
+        Record of sample for manifest, seed and placement.
     """
-    This function generates random position in image.Thus rand_y 
-    represent height index in image and rand_x width index.
+    # open augmented sign images
+    temp_imgs = [load_img(os.path.join(template_dir, temp_file), bgra=True) for temp_file in temp_files]
+    temps = [{"type": sign_type} for sign_type in sign_types]
 
-    In our real life dataset, signs usually dont appear in the top portion
-    of the image. Therefore we take that into count and probability 
-    of generating position in top part can be specified by top_pos parameter.
+    rng = np.random.RandomState(seed)
+    record = {"seed": int(seed), "background": os.path.basename(bg_path),
+              "templates": temp_files, "types": sign_types}
+    record.update(insert_signs(bg_img, temp_imgs, temps, class_dataset, detection_dataset, rng))
+    return record
 
-    Args:
-        top_pos - can be from interval <0,1> (0 meaning position will be
-            in bottom half of the image)
-    Returns:
-        [rand_x, rand_y] - coordinates of generated point
+
+def write_committed(records, manifest, class_dataset, detection_dataset):
     """
-    
-    if np.random.uniform(low=0, high=1) < top_pos:
-        rand_y = np.random.randint(low=0, high=img_shape[1]/2)
-    else:
-        rand_y = np.random.randint(low=img_shape[1]/2, high=img_shape[1])
+    Write records of samples into manifest once their images are committed
+    in both datasets, so after crash manifest does not contain images
+    which are generated again. Records are written in order of generation.
 
-    rand_x = np.random.randint(low=0, high=img_shape[0])
-    return [rand_x, rand_y]
+    Args:
+        records: deque of records waiting for commit, written records are removed
+    """
+    cls_committed = class_dataset.committed_index()
+    det_committed = detection_dataset.committed_index()
+    while len(records) > 0:
+        record = records[0]
+        if max(record["cls"], default=0) > cls_committed:
+            break
+        if record["det"] is not None and record["det"] > det_committed:
+            break
+        manifest.write(records.popleft())
 
 
 def insert_temp_to_bg():
@@ -145,39 +212,80 @@ def insert_temp_to_bg():
     signs. The position of each template in background is generated
     randomly. 
     Generates two datasets 1. classification dataset 2. detection dataset. 
+    Each image of detection dataset contains multiple signs (script argument
+    "objects"), which dont overlap.
+    Multiple processes can fill the same datasets (script argument "shared"),
+    each of them inserting different part of templates.
+
+    Every image of detection dataset (with its classification images) has
+    own seed. Seed and placement of sample are stored in manifest (script
+    argument "manifest") when its images are committed, samples of manifest can be generated again
+    (script arguments "replay" and "samples").
+
+    With target number of samples of classes (script arguments "targets" or
+    "target") only samples missing in classification dataset are generated,
+    classes are interleaved (class_scheduler). Parallel processes have to
+    be started together, every one computes schedule from the same counts.
     """
     args = parse_arguments()
-    class_dataset = DatasetGenerator(args.cls_dataset)
-    detection_dataset = DatasetGenerator(args.det_dataset)
-
-    template_aug_structure = load_temp(args.template)
-    background_imgs  = load_bg(args.bg)
-
-    for idx, temp in enumerate(template_aug_structure):
-        print("Progress: ", idx, "/", len(template_aug_structure))
-
-        # open augmented sign image
-        temp_img =  Image.open(os.path.join(args.template, temp["filename"]))
-        temp_width, temp_height = temp_img.size
-        width_offset = int(temp_width * 0.08)
-        height_offset = int(temp_height * 0.08)
-
-        # load background image 
-        bg_img = Image.open(background_imgs.pop())
-        bg_for_det_dataset = deepcopy(bg_img)
-        bg_for_cls_dataset = crop_random_part(deepcopy(bg_img), temp_width + width_offset + 1, temp_height + height_offset + 1)
-
-        # add them together
-        rand_pos = gen_pos_in_img(bg_for_det_dataset.size)
-        image, bbox = add_aug_signs(bg_for_det_dataset, temp_img, rand_pos)
-        detection_dataset.add_image(image, bbox, temp["type"])
-
-        image, bbox = add_aug_signs(bg_for_cls_dataset, temp_img, [int(width_offset/2), int(height_offset/2)])
-        class_dataset.add_image(image, bbox, temp["type"])
-
-        del(bg_img)
-        del(bg_for_cls_dataset)
-        del(bg_for_det_dataset)
+    class_dataset = DatasetGenerator(args.cls_dataset, args.gt_format, args.gt_flush, args.image_format, args.shard_size,
+                                     args.shared, io_threads=args.io_threads)
+    detection_dataset = DatasetGenerator(args.det_dataset, args.gt_format, args.gt_flush, args.image_format, args.shard_size,
+                                         args.shared, io_threads=args.io_threads)
+
+    manifest = SampleManifestWriter(args.manifest) if args.manifest is not None else None
+    records = deque()
+
+    if args.replay is not None:
+        samples = parse_samples(args.samples) if args.samples is not None else None
+        profiler = Profiler("Replay", total=len(samples) if samples is not None else None)
+        bg_path, bg_img = None, None
+        for _, record in iter_samples(args.replay, samples):
+            if os.path.join(args.bg, record["background"]) != bg_path:
+                bg_path = os.path.join(args.bg, record["background"])
+                bg_img = load_img(bg_path)
+            new_record = insert_sample(bg_path, bg_img, record["templates"], record["types"], record["seed"],
+                                       args.template, class_dataset, detection_dataset)
+            if manifest is not None:
+                records.append(new_record)
+                write_committed(records, manifest, class_dataset, detection_dataset)
+            profiler.update()
+    else:
+        template_aug_structure = load_temp(args.template)
+        if args.targets is not None or args.target is not None:
+            if args.targets is not None:
+                targets = load_targets(args.targets)
+            else:
+                targets = {temp["type"]: args.target for temp in template_aug_structure}
+            # classification dataset has single sign in every image
+            template_aug_structure = schedule(template_aug_structure, targets, class_dataset.class_counts())
+
+        # every process (script arguments "parts" and "part") inserts its own part of templates
+        template_aug_structure = template_aug_structure[args.part::args.parts]
+        seeds = np.random.RandomState(None if args.seed is None else [args.seed, args.part])
+        background_imgs  = BackgroundPool(load_bg(args.bg, seeds.randint(0, 2**31 - 1)), load_img, cache_size=args.bg_cache,
+                                          reuse=args.bg_reuse, policy=args.bg_policy, seed=seeds.randint(0, 2**31 - 1))
+
+        profiler = Profiler("Progress", total=len(template_aug_structure))
+        for start in range(0, len(template_aug_structure), args.objects):
+            group = template_aug_structure[start:start + args.objects]
+
+            # load background image, it is shared with background pool
+            bg_path, bg_img = background_imgs.next_with_path()
+            record = insert_sample(bg_path, bg_img, [temp["filename"] for temp in group], [temp["type"] for temp in group],
+                                   seeds.randint(0, 2**31 - 1), args.template, class_dataset, detection_dataset)
+            if manifest is not None:
+                records.append(record)
+                write_committed(records, manifest, class_dataset, detection_dataset)
+            profiler.update(len(group))
+
+    class_dataset.close()
+    detection_dataset.close()
+    if manifest is not None:
+        # all images are committed by close
+        write_committed(records, manifest, class_dataset, detection_dataset)
+        manifest.close()
+    profiler.finish(args.stats)
 
 if __name__ == "__main__":
     insert_temp_to_bg()
\ No newline at end of file
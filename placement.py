@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+##########################
+#
+# Author: Andrej Panicek
+# Desc  : Placement of multiple non-overlapping objects into image.
+#
+##########################
+import numpy as np
+
+
+def free_windows(occupied, win_h, win_w):
+    """
+    Find all positions in occupancy grid where window of given size
+    contains only free cells. Uses summed area table, so all positions 
+    are checked at once.
+
+    Returns:
+        Boolean array, True on position [y, x] means window with top left
+        corner in cell [y, x] is free.
+    """
+    grid_h, grid_w = occupied.shape
+    table = np.zeros((grid_h + 1, grid_w + 1), dtype=np.int32)
+    table[1:, 1:] = occupied.cumsum(axis=0).cumsum(axis=1)
+
+    sums = table[win_h:, win_w:] - table[:-win_h, win_w:] - table[win_h:, :-win_w] + table[:-win_h, :-win_w]
+    return sums == 0
+
+
+def place_objects(img_shape, obj_shapes, cell=8, top_pos=0.5, rng=None):
+    """
+    Generate random positions of objects in image, so no two objects
+    overlap and every object is whole inside of image. Image is divided
+    into grid of cells, cells covered by placed objects are marked as
+    occupied and next object is placed only into free cells. There are 
+    no retries, if there is no free space for object, it is skipped.
+
+    Probability that top left corner of object is in top half of image 
+    is specified by top_pos.
+
+    Args:
+        img_shape: shape of image (height, width, ...)
+        obj_shapes: list of shapes of objects (height, width, ...)
+        cell: size of grid cell in pixels
+        top_pos: can be from interval <0,1> (0 meaning position will be
+            in bottom half of the image)
+        rng: np.random.RandomState, global numpy generator if None
+
+    Returns:
+        List with [x, y] position of top left corner of each object,
+        None for objects which did not fit into image (or are empty).
+    """
+    rng = np.random if rng is None else rng
+    img_h, img_w = img_shape[:2]
+    occupied = np.zeros((-(-img_h // cell), -(-img_w // cell)), dtype=np.uint8)
+    positions = []
+
+    for obj_shape in obj_shapes:
+        obj_h, obj_w = obj_shape[:2]
+        win_h, win_w = -(-obj_h // cell), -(-obj_w // cell)
+        if obj_h == 0 or obj_w == 0:
+            # empty object (fully transparent augmented template)
+            positions.append(None)
+            continue
+        if obj_h > img_h or obj_w > img_w or win_h > occupied.shape[0] or win_w > occupied.shape[1]:
+            positions.append(None)
+            continue
+
+        # object has to be whole inside of image
+        free = free_windows(occupied, win_h, win_w)
+        free = free[:(img_h - obj_h) // cell + 1, :(img_w - obj_w) // cell + 1]
+
+        cells_y, cells_x = np.nonzero(free)
+        if len(cells_y) == 0:
+            positions.append(None)
+            continue
+
+        top = cells_y * cell < img_h / 2
+        if top.any() and (not top.all()):
+            in_top = rng.uniform(low=0, high=1) < top_pos
+            cells_y, cells_x = cells_y[top == in_top], cells_x[top == in_top]
+
+        choice = rng.randint(len(cells_y))
+        y, x = cells_y[choice], cells_x[choice]
+        occupied[y:y + win_h, x:x + win_w] = 1
+
+        # random shift inside of occupied cells
+        pos_x = x * cell + rng.randint(min(win_w * cell, img_w - x * cell) - obj_w + 1)
+        pos_y = y * cell + rng.randint(min(win_h * cell, img_h - y * cell) - obj_h + 1)
+        positions.append([int(pos_x), int(pos_y)])
+
+    return positions
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+##########################
+#
+# Author: Andrej Panicek
+# Desc  : Timing of generation stages and progress reporting.
+#
+##########################
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+# How often (in seconds) progress line is printed.
+PROGRESS_INTERVAL = 5.0
+
+# Statistics of this process, stage -> [count, seconds] and
+# queue -> [samples, sum of depths, max depth].
+_stages = {}
+_queues = {}
+_lock = threading.Lock()
+
+
+def add_time(name, seconds, count=1):
+    with _lock:
+        times = _stages.setdefault(name, [0, 0.0])
+        times[0] += count
+        times[1] += seconds
+
+
+@contextmanager
+def stage(name):
+    """
+    Measure time spent in block of code as stage name. Stages
+    running in multiple threads are summed up.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(name, time.perf_counter() - start)
+
+
+def record_queue(name, depth):
+    # sample depth of queue
+    with _lock:
+        depths = _queues.setdefault(name, [0, 0, 0])
+        depths[0] += 1
+        depths[1] += depth
+        depths[2] = max(depths[2], depth)
+
+
+def take_stats():
+    """
+    Return statistics collected in this process since the last call
+    and reset them. Worker processes send them to main process
+    along with results of jobs.
+    """
+    global _stages, _queues
+    with _lock:
+        stats = {"stages": _stages, "queues": _queues}
+        _stages, _queues = {}, {}
+    return stats
+
+
+class Profiler():
+    """
+    Collect statistics of single run: number of generated samples,
+    timings of stages and depths of queues (from this process and
+    merged from workers). Progress line is printed at most once
+    per PROGRESS_INTERVAL seconds.
+    """
+
+    def __init__(self, desc="Progress", total=None, interval=PROGRESS_INTERVAL):
+        self._desc = desc
+        self._total = total
+        self._interval = interval
+        self._start = time.perf_counter()
+        self._last_print = None
+        self._samples = 0
+        self._stages = {}
+        self._queues = {}
+
+    def merge(self, stats):
+        # add statistics from take_stats()
+        for name, (count, seconds) in stats["stages"].items():
+            times = self._stages.setdefault(name, [0, 0.0])
+            times[0] += count
+            times[1] += seconds
+        for name, (samples, total, maximum) in stats["queues"].items():
+            depths = self._queues.setdefault(name, [0, 0, 0])
+            depths[0] += samples
+            depths[1] += total
+            depths[2] = max(depths[2], maximum)
+
+    def update(self, count=1, stats=None):
+        """
+        Add count generated samples and statistics of worker (if any),
+        print progress if the last one was printed long ago.
+        """
+        self._samples += count
+        if stats is not None:
+            self.merge(stats)
+        now = time.perf_counter()
+        if self._last_print is None or now - self._last_print >= self._interval:
+            self._last_print = now
+            self.print_progress()
+
+    def rate(self):
+        elapsed = time.perf_counter() - self._start
+        return self._samples / elapsed if elapsed > 0 else 0.0
+
+    def print_progress(self):
+        line = self._desc + ": " + str(self._samples)
+        if self._total is not None:
+            line += " / " + str(self._total)
+        line += " (" + format(self.rate(), ".1f") + " samples/s)"
+        print(line, flush=True)
+
+    def summary(self):
+        """
+        Returns:
+            Dictionary with elapsed time, number of samples, samples per second,
+            count, total and mean time of every stage and mean and max
+            depth of every queue.
+        """
+        self.merge(take_stats())
+        stages = {}
+        for name, (count, seconds) in sorted(self._stages.items()):
+            stages[name] = {"count": count, "seconds": seconds,
+                            "mean_ms": 1000 * seconds / count if count > 0 else 0.0}
+        queues = {}
+        for name, (samples, total, maximum) in sorted(self._queues.items()):
+            queues[name] = {"mean": total / samples if samples > 0 else 0.0, "max": maximum}
+        return {"desc": self._desc,
+                "elapsed": time.perf_counter() - self._start,
+                "samples": self._samples,
+                "samples_per_sec": self.rate(),
+                "stages": stages,
+                "queues": queues}
+
+    def finish(self, path=None):
+        """
+        Print final progress and stage times, store summary
+        as json into path (if set).
+        """
+        self.print_progress()
+        summary = self.summary()
+        for name, times in summary["stages"].items():
+            print("  " + name + ": " + format(times["seconds"], ".2f") + " s, "
+                  + format(times["mean_ms"], ".2f") + " ms/call", file=sys.stderr)
+        if path is not None:
+            with open(path, "w") as stats_file:
+                json.dump(summary, stats_file, indent=2)
+        return summary
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+##########################
+#
+# Author: Andrej Panicek
+# Desc  : Manifest of generated samples, from which samples can be replayed.
+#
+##########################
+import json
+
+
+def parse_samples(text):
+    """
+    Parse selection of samples, e.g. "0-99,150" (ranges are inclusive).
+
+    Returns:
+        Set of sample numbers.
+    """
+    samples = set()
+    for part in text.split(","):
+        part = part.strip()
+        if part == "":
+            continue
+        if "-" in part:
+            first, last = part.split("-", 1)
+            samples.update(range(int(first), int(last) + 1))
+        else:
+            samples.add(int(part))
+    return samples
+
+
+def iter_samples(path, samples=None):
+    """
+    Lazy read records of manifest, sample number is number of line
+    in manifest. Incomplete last line (crashed generation) is skipped.
+
+    Args:
+        path: path to manifest
+        samples: set of sample numbers to read, all samples if None
+
+    Yields:
+        Sample number and its record.
+    """
+    with open(path, "r") as manifest_file:
+        for number, line in enumerate(manifest_file):
+            if samples is not None and number not in samples:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                if manifest_file.readline() == "":
+                    return
+                raise
+            yield number, record
+
+
+class SampleManifestWriter():
+    """
+    Append records of generated samples into manifest (json record
+    on every line). Every record contains seed of sample and its
+    placement parameters, so the sample can be generated again.
+    """
+
+    def __init__(self, path: str):
+        self._file = open(path, "a")
+
+    def write(self, record: dict):
+        self._file.write(json.dumps(record, separators=(",", ":")) + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+##########################
+#
+# Author: Andrej Panicek
+# Desc  : Generation of detection samples on the fly, for training loaders.
+#
+##########################
+import argparse
+import numpy as np
+from collections import OrderedDict
+
+from templates_utils import load_templates_structure
+from template_cache import TemplateCache
+from generate_aug_tmp import load_template, augment_batch
+from generate_ran_bg import list_dir_files, load_road_img
+from insert_templates_to_bg import add_aug_signs
+from img_utils import crop_random_part
+from placement import place_objects
+from profiler import Profiler
+
+# torch is optional, without it dataset is plain iterable
+try:
+    from torch.utils.data import IterableDataset, get_worker_info
+except ImportError:
+    IterableDataset = object
+    get_worker_info = None
+
+
+class SyntheticDataset(IterableDataset):
+    """
+    Iterable dataset which generates detection samples in memory,
+    nothing is stored on disk. Every sample is random crop of road
+    image with multiple augmented signs inserted into it.
+
+    Normalized templates and decoded road images are cached in memory.
+    Templates are augmented in batches, copies are kept per template
+    until they are used.
+
+    With torch DataLoader every worker process generates its own part
+    of samples with its own seed. Call set_epoch() before every epoch
+    to get different samples in every epoch (with the same seed).
+    Every iterator has its own random generator, global generators of
+    numpy and imgaug are not used.
+
+    Yields:
+        Image (BGR), bounding boxes of signs as array (N, 4) of
+        [x_start, y_start, x_end, y_end] and list of sign types.
+    """
+
+    def __init__(self, bg_dir, template_dir, temp_data, max_w, max_h, width, height,
+                 objects=1, length=None, seed=None, reduce=1, bg_reuse=16, bg_cache=8,
+                 batch=8, pyramid=False, cache=None):
+        """
+        Args:
+            bg_dir: directory with road images (without signs)
+            template_dir: directory with sign templates
+            temp_data: json file with description of templates
+            max_w, max_h: maximum size of normalized sign
+            width, height: size of generated images
+            objects: how many signs insert into every image
+            length: number of samples in epoch, endless if None
+            seed: base seed of random generators, random if None
+            reduce: decode road images in 1/reduce of their resolution
+            bg_reuse: how many samples crop from road image before next one is picked
+            bg_cache: how many decoded road images keep in memory
+            batch: how many copies of template augment at once
+            pyramid: scale down templates from pyramid levels
+            cache: directory with cache of normalized templates (TemplateCache)
+        """
+        self._bg_paths = list_dir_files(bg_dir)
+        self._template_dir = template_dir
+        self._templates_data = load_templates_structure(temp_data)
+        self._max_size = (max_w, max_h)
+        self._size = (width, height)
+        self._objects = objects
+        self._length = length
+        self._seed = seed
+        self._reduce = reduce
+        self._bg_reuse = max(1, bg_reuse)
+        self._bg_cache_size = max(1, bg_cache)
+        self._batch = max(1, batch)
+        self._pyramid = pyramid
+        self._cache_dir = cache
+        self._epoch = 0
+
+        # filled lazily, in every worker process separately
+        self._templates = None
+        self._backgrounds = OrderedDict()
+
+        self.classes = sorted(set(data["type"] for data in self._templates_data))
+
+    def set_epoch(self, epoch):
+        self._epoch = epoch
+
+    def _load_templates(self):
+        if self._templates is None:
+            cache = TemplateCache(self._cache_dir) if self._cache_dir is not None else None
+            self._templates = [load_template(self._template_dir, data, *self._max_size, cache)
+                               for data in self._templates_data]
+        return self._templates
+
+    def _background(self, path):
+        # decoded road image from LRU cache
+        if path in self._backgrounds:
+            self._backgrounds.move_to_end(path)
+            return self._backgrounds[path]
+        image = load_road_img(path, self._reduce)
+        self._backgrounds[path] = image
+        if len(self._backgrounds) > self._bg_cache_size:
+            self._backgrounds.popitem(last=False)
+        return image
+
+    def _augmented_template(self, temp_index, augmented, rng):
+        # next augmented copy of template, copies are created in batches
+        copies = augmented.get(temp_index)
+        if not copies:
+            norm_img, image_data = self._load_templates()[temp_index]
+            copies = augment_batch(norm_img, image_data["points"], self._batch, self._pyramid, rng)
+            augmented[temp_index] = copies
+        return copies.pop()
+
+    def _worker(self):
+        # id and number of workers of torch DataLoader
+        info = get_worker_info() if get_worker_info is not None else None
+        if info is None:
+            return 0, 1
+        return info.id, info.num_workers
+
+    def generate(self, bg_img, rng, augmented=None):
+        """
+        Create single sample from road image.
+
+        Args:
+            bg_img: road image
+            rng: np.random.RandomState of iterator
+            augmented: augmented copies of templates not used yet (per template index)
+
+        Returns:
+            Image, bounding boxes and sign types.
+        """
+        augmented = {} if augmented is None else augmented
+        width, height = self._size
+        image = crop_random_part(bg_img, width, height, rng=rng).copy()
+
+        temp_indexes = rng.randint(len(self._templates_data), size=self._objects)
+        temp_imgs = [self._augmented_template(idx, augmented, rng)[0] for idx in temp_indexes]
+        positions = place_objects(image.shape, [temp_img.shape for temp_img in temp_imgs], rng=rng)
+
+        bboxes = []
+        labels = []
+        for idx, temp_img, pos in zip(temp_indexes, temp_imgs, positions):
+            if pos is None:
+                # no free space left in image
+                continue
+            image, bbox = add_aug_signs(image, temp_img, pos)
+            bboxes.append(bbox)
+            labels.append(self._templates_data[idx]["type"])
+        return image, np.array(bboxes, dtype=np.int32).reshape(-1, 4), labels
+
+    def __iter__(self):
+        worker_id, workers = self._worker()
+        if self._seed is not None:
+            rng = np.random.RandomState([self._seed, self._epoch, worker_id])
+        else:
+            # fresh entropy, forked workers share state of global generator
+            rng = np.random.RandomState()
+        augmented = {}
+
+        if self._length is None:
+            count = None
+        else:
+            # samples of epoch are split between workers
+            count = self._length // workers + (1 if worker_id < self._length % workers else 0)
+
+        generated = 0
+        while count is None or generated < count:
+            bg_img = self._background(self._bg_paths[rng.randint(len(self._bg_paths))])
+            for _ in range(self._bg_reuse):
+                if count is not None and generated >= count:
+                    return
+                yield self.generate(bg_img, rng, augmented)
+                generated += 1
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bg', required=True, help='Path to directory with road images (without signs).')
+    parser.add_argument('--src', required=True, help='Path to sign templates directory.')
+    parser.add_argument('--temp_data', required=True, help='Path to json file which contains description about each sign.')
+    parser.add_argument('--max_w', type=int, required=True, help='Maximum width of sign.')
+    parser.add_argument('--max_h', type=int, required=True, help='Maximum height of sign.')
+    parser.add_argument('--width', type=int, required=True, help='Width of generated images.')
+    parser.add_argument('--height', type=int, required=True, help="Height of generated images.")
+    parser.add_argument('--objects', type=int, default=1, help='How many signs insert into each image (default 1).')
+    parser.add_argument('--count', type=int, default=100, help='How many samples generate (default 100).')
+    parser.add_argument('--seed', type=int, default=None, help='Seed of random generators, random if not set.')
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    # Generate samples and report how fast they are generated.
+    args = parse_arguments()
+    dataset = SyntheticDataset(args.bg, args.src, args.temp_data, args.max_w, args.max_h,
+                               args.width, args.height, args.objects, args.count, args.seed)
+    profiler = Profiler("Generated", total=args.count)
+    for image, bboxes, labels in dataset:
+        profiler.update()
+    profiler.finish()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+##########################
+#
+# Author: Andrej Panicek
+# Desc  : Cache of normalized sign templates.
+#
+##########################
+import os
+import json
+import hashlib
+
+from img_utils import load_img, store_img
+
+# Change when normalization of templates changes, so old cache is not used.
+CACHE_VERSION = 2
+
+
+def template_key(path, points, max_w, max_h):
+    """
+    Hash of template file content, its points and normalized size.
+    Template with the same key gives the same normalized template.
+    """
+    key = hashlib.sha1()
+    with open(path, "rb") as temp_file:
+        for chunk in iter(lambda: temp_file.read(1 << 20), b""):
+            key.update(chunk)
+    key.update(json.dumps([points, max_w, max_h, CACHE_VERSION]).encode())
+    return key.hexdigest()
+
+
+class TemplateCache():
+    """
+    Store normalized templates with their rescaled points in directory,
+    every template is stored under its key as <key>.png and <key>.json.
+    """
+
+    def __init__(self, cache_dir):
+        self._cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _paths(self, key):
+        path = os.path.join(self._cache_dir, key)
+        return path + ".png", path + ".json"
+
+    def load(self, key):
+        """
+        Returns:
+            Normalized template and its points, None if template is not in cache.
+        """
+        img_path, points_path = self._paths(key)
+        if not (os.path.isfile(img_path) and os.path.isfile(points_path)):
+            return None
+        with open(points_path, "r") as points_file:
+            points = json.load(points_file)
+        return load_img(img_path, bgra=True), points
+
+    def store(self, key, image, points):
+        img_path, points_path = self._paths(key)
+        store_img(img_path, image)
+        # points are written last, so only complete records are loaded
+        with open(points_path + ".tmp", "w") as points_file:
+            json.dump(points, points_file)
+        os.replace(points_path + ".tmp", points_path)
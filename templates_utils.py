@@ -8,31 +8,80 @@ import json
 import os
 import sys
 
+def iter_templates_structure(path: str):
+    # Lazy load ground truths from file, records are read one by one.
+    # Files written by TemplatesStructureWriter have single record on 
+    # every line and can be read even if generation crashed (missing
+    # closing bracket, incomplete last record). Other JSON files are
+    # loaded at once.
+
+    with open(path, 'r') as temp_file:
+        first_line = temp_file.readline().strip()
+        read_lines = 0
+        if first_line == "[":
+            for line in temp_file:
+                line = line.strip().rstrip(",")
+                if line in ("", "]"):
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    if read_lines == 0:
+                        break
+                    if temp_file.readline() == "":
+                        # last record was not completely written
+                        return
+                    raise
+                read_lines += 1
+                yield record
+            else:
+                return
+
+    # not one record per line structure
+    with open(path, 'r') as temp_file:
+        yield from json.load(temp_file)
+
 def load_templates_structure(path: str):
     # Load ground truths from file. 
     # The file has JSON structure. 
 
-    with open(path, 'r') as temp_file:
-        struct = json.load(temp_file)
-    return struct
+    return list(iter_templates_structure(path))
+
+class TemplatesStructureWriter():
+    """
+    Save ground truths into file as soon as they are created, so
+    they dont have to be kept in memory. The file has JSON structure
+    with single record on every line.
+    """
+
+    def __init__(self, path: str):
+        self._count = 0
+        self._file = open(path, 'w')
+        self._file.write("[\n")
+
+    def write(self, record: dict):
+        if self._count > 0:
+            self._file.write(",\n")
+        json.dump(record, self._file)
+        self._file.flush()
+        self._count += 1
+
+    def close(self):
+        self._file.write("\n]")
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
 def store_templates_structure(path: str, data: list):
     # Save ground truths into file.
 
-    if not os.path.exists(path):
-        open(path, 'a').close()
-    with open(path, 'w') as temp_file:
-        temp_file.write("[\n")
-        last_one_stamp = data[-1]
-
+    with TemplatesStructureWriter(path) as writer:
         for image in data:
-            json.dump(image, temp_file)
-            if image == last_one_stamp:
-                #after last record, dont print comma
-                temp_file.write("\n")
-            else:
-                temp_file.write(",\n")
-        temp_file.write("]")
+            writer.write(image)
     
 def gen_template_dir(root_path, name):
     path = os.path.abspath(os.path.join(root_path, name))
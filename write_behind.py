@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+##########################
+#
+# Author: Andrej Panicek
+# Desc  : Asynchronous storing of generated data.
+#
+##########################
+import queue
+import threading
+
+
+class WriteBehind():
+    """
+    Run write operations (encoding and storing of images, ground truths)
+    in pool of writer threads, so generating thread does not have to wait
+    for disk. Queue of pending writes is bounded, submit() blocks when 
+    it is full.
+
+    Errors of writes are raised by the next submit(), join() or close().
+    With zero threads writes are done directly in submit().
+    """
+
+    def __init__(self, threads=4, max_pending=64):
+        self._error = None
+        self._threads = []
+        self._queue = queue.Queue(maxsize=max(1, max_pending))
+        for _ in range(threads):
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            try:
+                if task is None:
+                    return
+                func, args = task
+                func(*args)
+            except Exception as err:
+                self._error = err
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def pending(self):
+        # number of writes waiting in queue
+        return self._queue.qsize()
+
+    def submit(self, func, *args):
+        """
+        Schedule func(*args). Arguments must not be modified by 
+        caller after submit.
+        """
+        self._raise_error()
+        if len(self._threads) == 0:
+            func(*args)
+        else:
+            self._queue.put((func, args))
+
+    def join(self):
+        """
+        Wait until all submitted writes are done.
+        """
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        self._queue.join()
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self._raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()